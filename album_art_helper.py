@@ -1,77 +1,357 @@
 import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeout
+
 import requests
-from mutagen import File as MutagenFile
-
-def has_embedded_art(filepath):
-    audio = MutagenFile(filepath)
-    if audio is None:
-        return False
-    # MP3
-    if hasattr(audio, 'tags') and audio.tags is not None:
-        for tag in audio.tags.keys():
-            if tag.startswith('APIC'):
-                return True
-    # FLAC
-    if hasattr(audio, 'pictures') and audio.pictures:
-        return True
-    # M4A/ALAC
-    if hasattr(audio, 'tags') and audio.tags is not None:
-        if 'covr' in audio.tags:
-            return True
-    return False
+from mutagen.mp4 import MP4, MP4Cover
+
+from probe_helpers import probe
+from file_helpers import run_ffmpeg
+from index_helpers import normalize_tag
+from zip_helpers import split_zip_member_path, zip_covers_dir
+from metrics_helpers import metrics
+
+logger = logging.getLogger(__name__)
+
+MUSICBRAINZ_URL = 'https://musicbrainz.org'
+COVERART_URL = 'https://coverartarchive.org'
+USER_AGENT = 'slsync/1.0 (album art lookup)'
+LOCAL_ART_NAMES = ['cover.jpg', 'folder.jpg', 'artwork.jpg', 'cover.png', 'folder.png', 'artwork.png']
+# Release groups to try on Cover Art Archive before giving up on an album
+MAX_RELEASE_GROUPS = 3
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+JPEG_MAGIC = b'\xff\xd8\xff'
 
 def find_local_art(directory):
-    for fname in ['cover.jpg', 'folder.jpg', 'artwork.jpg', 'cover.png', 'folder.png', 'artwork.png']:
+    for fname in LOCAL_ART_NAMES:
         path = os.path.join(directory, fname)
         if os.path.exists(path):
             return path
     return None
 
-def fetch_album_art_from_musicbrainz(artist, album, dest_path):
+def art_directory(filepath):
+    """Folder to look in for cover images: zip members use the folder their covers were extracted to"""
+    zip_member = split_zip_member_path(filepath)
+    if zip_member:
+        zip_path, member = zip_member
+        return os.path.join(zip_covers_dir(zip_path), os.path.dirname(member))
+    return os.path.dirname(filepath)
+
+def album_key(artist, album):
+    """Cache key for an album, so 'The Band ' and 'the band' share one lookup"""
+    return f'{normalize_tag(artist)}\x1f{normalize_tag(album)}'
+
+def _lucene_phrase(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class TokenBucket:
+    """Blocking token bucket: at most `rate` acquisitions per second, with bursts of up to `capacity`"""
+
+    def __init__(self, rate=1.0, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def fetch_album_art_from_musicbrainz(artist, album, dest_path, session=None, limiter=None,
+                                     musicbrainz_url=MUSICBRAINZ_URL, coverart_url=COVERART_URL, timeout=10):
+    """
+    Look up the album on MusicBrainz and save its Cover Art Archive front image to dest_path.
+    Returns False when the album or its art doesn't exist; network and server errors raise
+    requests.RequestException so callers can tell a miss from a failed lookup.
+    """
+    session = session or requests
     # Search for release group
-    query = f'https://musicbrainz.org/ws/2/release-group/?query=artist:{artist}%20AND%20releasegroup:{album}&fmt=json'
-    resp = requests.get(query)
-    if resp.status_code != 200:
-        return False
-    data = resp.json()
-    if not data.get('release-groups'):
-        return False
-    release_group = data['release-groups'][0]
-    mbid = release_group['id']
+    if limiter is not None:
+        limiter.acquire()
+    resp = session.get(
+        f'{musicbrainz_url.rstrip("/")}/ws/2/release-group/',
+        params={'query': f'artist:{_lucene_phrase(artist)} AND releasegroup:{_lucene_phrase(album)}',
+                'fmt': 'json', 'limit': MAX_RELEASE_GROUPS},
+        timeout=timeout,
+    )
+    resp.raise_for_status()
+    release_groups = resp.json().get('release-groups') or []
     # Fetch cover art
-    art_url = f'https://coverartarchive.org/release-group/{mbid}/front'
-    art_resp = requests.get(art_url)
-    if art_resp.status_code == 200:
-        with open(dest_path, 'wb') as f:
+    for release_group in release_groups[:MAX_RELEASE_GROUPS]:
+        art_url = f'{coverart_url.rstrip("/")}/release-group/{release_group["id"]}/front'
+        art_resp = session.get(art_url, timeout=timeout)
+        if art_resp.status_code == 404:
+            continue
+        art_resp.raise_for_status()
+        tmp_path = f'{dest_path}.part'
+        with open(tmp_path, 'wb') as f:
             f.write(art_resp.content)
+        os.replace(tmp_path, dest_path)
         return True
     return False
 
-def ensure_album_art(filepath, extract_dir):
-    if has_embedded_art(filepath):
-        print(f"[ART] Embedded album art found in {filepath}")
-        return True
-    local_art = find_local_art(extract_dir)
-    if local_art:
-        print(f"[ART] Found local album art: {local_art}")
-        # Optionally, embed this art into the audio file here
-        return True
-    # Try to fetch from MusicBrainz
-    audio = MutagenFile(filepath)
-    artist = None
-    album = None
-    if audio is not None:
-        if 'artist' in audio.tags:
-            artist = audio.tags['artist'][0] if isinstance(audio.tags['artist'], list) else audio.tags['artist']
-        if 'album' in audio.tags:
-            album = audio.tags['album'][0] if isinstance(audio.tags['album'], list) else audio.tags['album']
-    if artist and album:
-        dest_path = os.path.join(extract_dir, 'cover.jpg')
-        if fetch_album_art_from_musicbrainz(artist, album, dest_path):
-            print(f"[ART] Downloaded album art from MusicBrainz: {dest_path}")
-            return True
+
+class ArtResolver:
+    """
+    Album-level cover art lookup with a persistent cache.
+    Results are keyed by normalized (artist, album): covers that were found are kept
+    as files in cache_dir and misses are remembered for negative_ttl seconds, so each
+    album goes to the network at most once no matter how many tracks it has. Lookups
+    share one keep-alive session, are rate limited for MusicBrainz, and run on a small
+    thread pool so discovery can prefetch art without waiting on it.
+    """
+
+    def __init__(self, db_path, cache_dir, musicbrainz_url=MUSICBRAINZ_URL, coverart_url=COVERART_URL,
+                 rate=1.0, workers=2, timeout=10, negative_ttl=7 * 86400):
+        self.cache_dir = cache_dir
+        self.musicbrainz_url = musicbrainz_url
+        self.coverart_url = coverart_url
+        self.timeout = timeout
+        self.negative_ttl = negative_ttl
+        self.limiter = TokenBucket(rate)
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max(1, workers))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='art')
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.fetches = 0
+        self.errors = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS album_art ('
+            ' key TEXT PRIMARY KEY,'
+            ' artist TEXT NOT NULL,'
+            ' album TEXT NOT NULL,'
+            ' path TEXT,'
+            ' fetched REAL NOT NULL)'
+        )
+        self.conn.commit()
+
+    def _cached(self, key):
+        """Return (found, path); a remembered miss is found with path None. Caller holds the lock."""
+        row = self.conn.execute('SELECT path, fetched FROM album_art WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return False, None
+        path, fetched = row
+        if path is None:
+            if time.time() - fetched > self.negative_ttl:
+                return False, None
+            self.negative_hits += 1
+            return True, None
+        if not os.path.exists(path):
+            return False, None
+        self.hits += 1
+        return True, path
+
+    def lookup(self, artist, album):
+        """Cached result only, without touching the network"""
+        with self.lock:
+            return self._cached(album_key(artist, album))
+
+    def prefetch(self, artist, album):
+        """Start resolving an album in the background; returns a Future for the cover path (or None)"""
+        key = album_key(artist, album)
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is not None:
+                return future
+            found, path = self._cached(key)
+            if found:
+                future = Future()
+                future.set_result(path)
+                return future
+            future = self.pool.submit(self._fetch, key, artist, album)
+            self.inflight[key] = future
+        return future
+
+    def resolve(self, artist, album, timeout=None):
+        """
+        Cover image path for the album, or None if it has none; waits for any lookup in progress,
+        for at most timeout seconds if given (then raises ArtPending, and the lookup carries on)
+        """
+        try:
+            return self.prefetch(artist, album).result(timeout)
+        except FutureTimeout:
+            raise ArtPending(f"{artist} - {album}")
+
+    def _fetch(self, key, artist, album):
+        dest_path = os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.jpg')
+        try:
+            with metrics.span('art_fetch'):
+                found = fetch_album_art_from_musicbrainz(
+                    artist, album, dest_path, self.session, self.limiter,
+                    self.musicbrainz_url, self.coverart_url, self.timeout)
+        except (requests.RequestException, ValueError, OSError) as e:
+            # Transient failure: don't remember it, the next track of the album can retry
+            logger.warning("Album art lookup failed for %s - %s: %s", artist, album, e)
+            with self.lock:
+                self.errors += 1
+                self.inflight.pop(key, None)
+            metrics.inc('slsync_art_lookups_total', outcome='error')
+            return None
+        path = dest_path if found else None
+        with self.lock:
+            self.fetches += 1
+            self.conn.execute(
+                'INSERT OR REPLACE INTO album_art (key, artist, album, path, fetched) VALUES (?, ?, ?, ?, ?)',
+                (key, artist, album, path, time.time())
+            )
+            self.conn.commit()
+            self.inflight.pop(key, None)
+        metrics.inc('slsync_art_lookups_total', outcome='found' if found else 'missing')
+        if found:
+            logger.info("Downloaded album art for %s - %s", artist, album)
         else:
-            print(f"[ART] Could not fetch album art from MusicBrainz for {artist} - {album}")
-    else:
-        print(f"[ART] No artist/album metadata found for {filepath}")
-    return False
+            logger.info("No album art on MusicBrainz for %s - %s", artist, album)
+        return path
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'fetches': self.fetches,
+                'errors': self.errors,
+                'inflight': len(self.inflight),
+            }
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.session.close()
+        with self.lock:
+            self.conn.close()
+
+
+def image_format(path):
+    """'jpeg', 'png' or None, from the file's magic bytes"""
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    if head.startswith(JPEG_MAGIC):
+        return 'jpeg'
+    if head.startswith(PNG_MAGIC):
+        return 'png'
+    return None
+
+
+class CoverCache:
+    """
+    Content-addressed store of covers shrunk for embedding.
+    Resized copies are named after the SHA-256 of the original image, so a large
+    scan is recompressed once and then shared by every track (and every album)
+    that uses it. Covers that are already small JPEG/PNG files are used as-is.
+    """
+
+    def __init__(self, cache_dir, max_dimension=1000, max_bytes=512 * 1024):
+        self.cache_dir = cache_dir
+        self.max_dimension = max_dimension
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.digests = {}   # (path, size, mtime_ns) -> sha256 of the image
+        self.building = {}  # output path -> lock held while it is being written
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _digest(self, path, st):
+        key = (path, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            digest = self.digests.get(key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            digest = h.hexdigest()
+            with self.lock:
+                self.digests[key] = digest
+        return digest
+
+    def prepare(self, path):
+        """Path of an embeddable version of the cover at `path`, or None if it can't be made"""
+        st = os.stat(path)
+        if st.st_size <= self.max_bytes and image_format(path):
+            return path
+        out_path = os.path.join(self.cache_dir, f'{self._digest(path, st)}-{self.max_dimension}.jpg')
+        if os.path.exists(out_path):
+            return out_path
+        with self.lock:
+            build_lock = self.building.setdefault(out_path, threading.Lock())
+        with build_lock:
+            if not os.path.exists(out_path):
+                self._resize(path, out_path)
+        with self.lock:
+            self.building.pop(out_path, None)
+        return out_path if os.path.exists(out_path) else None
+
+    def _resize(self, path, out_path):
+        tmp_path = out_path[:-len('.jpg')] + '.part.jpg'
+        # Shrink to fit max_dimension, never enlarge (commas in the expressions are escaped for the filtergraph)
+        limit = self.max_dimension
+        cmd = [
+            'ffmpeg', '-v', 'error', '-y', '-i', path,
+            '-vf', f'scale=min({limit}\\,iw):min({limit}\\,ih):force_original_aspect_ratio=decrease',
+            '-frames:v', '1', '-q:v', '3', tmp_path
+        ]
+        returncode, stderr = run_ffmpeg(cmd)
+        if returncode != 0 or not os.path.exists(tmp_path):
+            logger.warning("Could not resize cover %s: %s", path, stderr.strip())
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        os.replace(tmp_path, out_path)
+        logger.info("Resized cover %s (%s KB -> %s KB)", os.path.basename(path),
+                    os.path.getsize(path) // 1024, os.path.getsize(out_path) // 1024)
+
+
+def embed_art_in_place(filepath, cover_path):
+    """Set the front cover of an MP4/ALAC file by updating its tags only (no re-encode)"""
+    with open(cover_path, 'rb') as f:
+        data = f.read()
+    fmt = MP4Cover.FORMAT_PNG if data.startswith(PNG_MAGIC) else MP4Cover.FORMAT_JPEG
+    audio = MP4(filepath)
+    audio['covr'] = [MP4Cover(data, imageformat=fmt)]
+    audio.save()
+
+
+class ArtPending(Exception):
+    """The album's online cover lookup didn't finish in the time the caller was willing to wait"""
+
+
+def find_album_art(filepath, info=None, resolver=None, timeout=None):
+    """
+    Path of a cover image for the track's album (local file first, then the resolver), or None.
+    With timeout, raises ArtPending if the resolver's lookup takes longer than that.
+    """
+    local_art = find_local_art(art_directory(filepath))
+    if local_art:
+        return local_art
+    if resolver is None:
+        return None
+    info = info or probe(filepath)
+    artist = info.tag('albumartist') or info.tag('artist')
+    album = info.tag('album')
+    if not (artist and album):
+        return None
+    return resolver.resolve(artist, album, timeout)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Reproducible benchmark for the slsync ingest stages.
+
+Generates a synthetic corpus with ffmpeg's lavfi sources (tagged FLAC/MP3/WAV
+tracks in nested album folders with cover images, zipped albums, and a library
+pre-populated with ALAC copies of some tracks as planted duplicates), then times
+each stage on its own and the whole pipeline end to end (main.py's album-job
+stages, run against a generated config). Results are written as JSON so
+runs can be compared across versions.
+
+    python benchmark.py --tracks 40 --seconds 30 --output bench.json
+"""
+
+import os
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import yaml
+
+from file_helpers import find_audio_files, extract_metadata, compute_audio_hash, convert_to_alac
+from duplication_helpers import is_duplicate, construct_audio_dest
+from probe_helpers import probe, probe_many
+from index_helpers import LibraryIndex
+from cache_helpers import ProbeCache
+from pipeline_helpers import group_consecutive
+from fingerprint_helpers import fingerprint_available
+from zip_helpers import zip_covers_dir
+
+SUPPORTED_EXTENSIONS = {'.mp3', '.flac', '.wav', '.aac', '.m4a', '.ogg', '.alac'}
+FORMAT_ARGS = {
+    'flac': ['-c:a', 'flac'],
+    'mp3': ['-c:a', 'libmp3lame', '-b:a', '320k'],
+    'wav': ['-c:a', 'pcm_s16le'],
+}
+DUP_MODES = {
+    'metadata': {'METADATA': {'TITLE': True, 'ARTIST': True, 'ALBUM': True}},
+    'audio_properties': {'AUDIO_PROPERTIES': {'DURATION': True, 'SAMPLE_RATE': True, 'CHANNELS': True}},
+    'audio_hash': {'AUDIO_HASH': True},
+}
+if fingerprint_available():
+    DUP_MODES['audio_fingerprint'] = {'AUDIO_FINGERPRINT': {'ENABLED': True, 'THRESHOLD': 0.8}}
+
+
+def ffmpeg_synth(out_path, seconds, freq, fmt, tags):
+    """Render a tagged stereo test tone (sine plus a little noise so encoders do real work)"""
+    cmd = [
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'sine=frequency={freq}:sample_rate=44100:duration={seconds}',
+        '-f', 'lavfi', '-i', f'anoisesrc=color=pink:amplitude=0.05:sample_rate=44100:duration={seconds}',
+        '-filter_complex', '[0:a][1:a]amix=inputs=2,aformat=channel_layouts=stereo',
+    ]
+    for key, value in tags.items():
+        cmd += ['-metadata', f'{key}={value}']
+    cmd += FORMAT_ARGS.get(fmt, ['-c:a', 'alac']) + [out_path]
+    subprocess.run(cmd, check=True)
+
+
+def ffmpeg_cover(out_path, size=600):
+    """Render a plain JPEG cover for an album folder"""
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', f'color=c=navy:s={size}x{size}',
+                    '-frames:v', '1', out_path], check=True)
+
+
+def build_corpus(root, args):
+    """Create downloads/ and library/ under root; returns a description of what was made"""
+    downloads = os.path.join(root, 'downloads')
+    library = os.path.join(root, 'library')
+    os.makedirs(downloads)
+    os.makedirs(library)
+    formats = args.formats.split(',')
+    tracks = []
+    for i in range(args.tracks):
+        album_no = i // args.album_size
+        tags = {
+            'artist': f'Bench Artist {album_no % 7}',
+            'album': f'Bench Album {album_no}',
+            'title': f'Track {i}',
+            'track': str(i % args.album_size + 1),
+            'disc': '1',
+        }
+        fmt = formats[i % len(formats)]
+        folder = os.path.join(downloads, tags['artist'], tags['album'], f'CD{1 + (i % 2)}')
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{int(tags['track']):02d} {tags['title']}.{fmt}")
+        ffmpeg_synth(path, args.seconds, 220 + 10 * i, fmt, tags)
+        tracks.append((path, tags))
+    covers = 0
+    for folder in sorted({os.path.dirname(p) for p, _ in tracks}):
+        ffmpeg_cover(os.path.join(folder, 'cover.jpg'))
+        covers += 1
+
+    # Plant duplicates: ALAC copies in the library at the Apple Music path
+    # (WAV tags written by ffmpeg are RIFF INFO, which mutagen doesn't read, so skip those)
+    planted = 0
+    taggable = [(p, t) for p, t in tracks if not p.endswith('.wav')]
+    for path, tags in taggable[:args.duplicates]:
+        dest = construct_audio_dest(library, path, '.m4a')
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        subprocess.run(['ffmpeg', '-v', 'error', '-y', '-i', path, '-c:a', 'alac', dest], check=True)
+        planted += 1
+
+    # Zip up the last few albums, the way they arrive from a download site
+    zipped = 0
+    album_dirs = sorted({os.path.dirname(os.path.dirname(p)) for p, _ in tracks})
+    for album_dir in album_dirs[-args.zips:] if args.zips else []:
+        zip_path = album_dir + '.zip'
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for dirpath, _, filenames in os.walk(album_dir):
+                for name in filenames:
+                    full = os.path.join(dirpath, name)
+                    zf.write(full, os.path.relpath(full, os.path.dirname(album_dir)))
+            zf.writestr('scans/booklet.nfo', 'not audio' * 1000)
+        shutil.rmtree(album_dir)
+        zipped += 1
+    return {'downloads': downloads, 'library': library, 'tracks': args.tracks,
+            'duplicates': planted, 'zips': zipped, 'covers': covers}
+
+
+def timed(fn, repeat):
+    """Run fn `repeat` times; return (last result, timing summary in seconds)"""
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return result, {
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'max': max(samples),
+        'runs': repeat,
+    }
+
+
+def drop_zip_covers(tree):
+    """Remove the covers listing a tree's archives extracted (the watcher drops them with the archive)"""
+    for dirpath, _, filenames in os.walk(tree):
+        for name in filenames:
+            if name.lower().endswith('.zip'):
+                shutil.rmtree(zip_covers_dir(os.path.join(dirpath, name)), ignore_errors=True)
+
+
+def copy_downloads(corpus, root, name):
+    """Fresh copy of the downloads tree for stages that consume their input"""
+    dest = os.path.join(root, name)
+    shutil.copytree(corpus['downloads'], dest)
+    return dest
+
+
+def load_ingest(root, corpus, args):
+    """
+    Import main.py against a benchmark config, so the end-to-end run drives the
+    watcher's own album-job stages (probe_many, dedup, route, covers, convert, move)
+    """
+    config = {
+        'DOWNLOAD_FOLDERS': [corpus['downloads']],
+        'DEST_FOLDER': os.path.join(root, 'dest'),
+        'LIBRARY_FOLDER': corpus['library'],
+        'SUPPORTED_EXTENSIONS': sorted(SUPPORTED_EXTENSIONS),
+        'CONVERSION': {'WORKERS': args.workers},
+        'LOGGING': {'LEVEL': 'WARNING'},
+        'CACHE': {'PATH': os.path.join(root, 'bench_cache.db')},
+        'ALBUM_ART': {'ENABLED': True, 'ONLINE_LOOKUP': False, 'CACHE_DIR': os.path.join(root, 'art')},
+        'SKIP_DUPLICATES': {'ENABLED': True, 'CRITERIA': DUP_MODES['metadata']},
+    }
+    config_path = os.path.join(root, 'bench_config.yaml')
+    with open(config_path, 'w') as f:
+        yaml.safe_dump(config, f)
+    os.environ['SLSYNC_CONFIG'] = config_path
+    import main
+    return main
+
+
+def run_ingest(ingest, corpus, root, name):
+    """Ingest a fresh copy of the downloads with main.py's pipeline; returns the journaled outcomes"""
+    tree = copy_downloads(corpus, root, name)
+    dest = os.path.join(root, f"{name}-dest")
+    os.makedirs(dest)
+    db_path = os.path.join(root, f"{name}.db")
+    context = ingest.build_context(dest, db_path)
+    pipeline = ingest.build_pipeline()
+    pipeline.submit(tree)
+    pipeline.shutdown()
+    states = context.ingest_journal.counts()
+    context.close()
+    counts = {
+        'imported': states.get('done', 0),
+        'duplicates': states.get('duplicate', 0),
+        'failed': states.get('failed', 0),
+    }
+    shutil.rmtree(tree)
+    shutil.rmtree(dest)
+    shutil.rmtree(ingest.ALBUM_ART_CACHE_DIR, ignore_errors=True)
+    return counts
+
+
+def bench(args):
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'version': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'ffmpeg': ffmpeg_version(),
+        'params': vars(args),
+        'stages': {},
+    }
+    stages = results['stages']
+    root = args.workdir or tempfile.mkdtemp(prefix='slsync-bench-')
+    os.makedirs(root, exist_ok=True)
+    try:
+        print(f"[BENCH] Generating corpus in {root}")
+        corpus, stages['generate'] = timed(lambda: build_corpus(root, args), 1)
+        results['corpus'] = corpus
+
+        files, stages['find_audio_files'] = timed(
+            lambda: list(find_audio_files(corpus['downloads'], SUPPORTED_EXTENSIONS)), args.repeat)
+        plain = [f for f in files if '.zip!/' not in f]
+        print(f"[BENCH] Found {len(files)} audio file(s)")
+
+        _, stages['probe'] = timed(lambda: [probe(f) for f in files], args.repeat)
+        albums = [group for _, group in group_consecutive(files, os.path.dirname)]
+        _, stages['probe_many'] = timed(lambda: [probe_many(group) for group in albums], args.repeat)
+        _, stages['extract_metadata'] = timed(
+            lambda: [extract_metadata(f, ['artist', 'album', 'title']) for f in files], args.repeat)
+
+        # Duplicate checks: each planted duplicate against its library copy, per criteria mode
+        pairs = []
+        for f in plain:
+            try:
+                dest = construct_audio_dest(corpus['library'], f, '.m4a')
+            except ValueError:
+                continue
+            if os.path.exists(dest):
+                pairs.append((f, dest))
+        index_db = os.path.join(root, 'index.db')
+        index = LibraryIndex(corpus['library'], index_db, SUPPORTED_EXTENSIONS)
+        _, stages['library_index_build'] = timed(index.build, 1)
+        _, stages['library_index_lookup'] = timed(lambda: [index.find_candidates(f) for f in files], args.repeat)
+        index.close()
+        for mode, criteria in DUP_MODES.items():
+            found, stages[f'is_duplicate[{mode}]'] = timed(
+                lambda: sum(is_duplicate(f, d, criteria) for f, d in pairs), args.repeat)
+            stages[f'is_duplicate[{mode}]']['pairs'] = len(pairs)
+            stages[f'is_duplicate[{mode}]']['matched'] = found
+            cache = ProbeCache(os.path.join(root, f'cache-{mode}.db'))
+            for f, d in pairs:  # warm the cache
+                is_duplicate(f, d, criteria, cache)
+            _, stages[f'is_duplicate[{mode}]+cache'] = timed(
+                lambda: sum(is_duplicate(f, d, criteria, cache) for f, d in pairs), args.repeat)
+            cache.close()
+
+        _, stages['compute_audio_hash'] = timed(lambda: [compute_audio_hash(f) for f in plain], args.repeat)
+
+        # Conversion writes next to its input, so each run gets a fresh copy
+        run = {'n': 0}
+        def convert_all():
+            run['n'] += 1
+            tree = copy_downloads(corpus, root, f"convert-{run['n']}")
+            out = [convert_to_alac(f) for f in find_audio_files(tree, SUPPORTED_EXTENSIONS)]
+            drop_zip_covers(tree)
+            shutil.rmtree(tree)
+            return sum(1 for o in out if o)
+        converted, stages['convert_to_alac'] = timed(convert_all, args.repeat)
+        stages['convert_to_alac']['files'] = converted
+
+        ingest = load_ingest(root, corpus, args)
+        def end_to_end():
+            run['n'] += 1
+            return run_ingest(ingest, corpus, root, f"e2e-{run['n']}")
+        counts, stages['end_to_end'] = timed(end_to_end, args.repeat)
+        stages['end_to_end'].update(counts)
+        handled = counts['imported'] + counts['duplicates']
+        stages['end_to_end']['files_per_sec'] = handled / stages['end_to_end']['median'] if handled else 0.0
+    finally:
+        if 'corpus' in results:
+            drop_zip_covers(results['corpus']['downloads'])
+        if not args.keep and not args.workdir:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.realpath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def ffmpeg_version():
+    try:
+        return subprocess.check_output(['ffmpeg', '-version']).decode().splitlines()[0]
+    except Exception:
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the slsync ingest stages on a synthetic corpus.')
+    parser.add_argument('--tracks', type=int, default=24, help='number of tracks to generate')
+    parser.add_argument('--seconds', type=float, default=20, help='length of each track in seconds')
+    parser.add_argument('--album-size', type=int, default=8, help='tracks per album folder')
+    parser.add_argument('--formats', default='flac,mp3,wav', help='comma separated source formats')
+    parser.add_argument('--duplicates', type=int, default=6, help='tracks to plant in the library as duplicates')
+    parser.add_argument('--zips', type=int, default=1, help='number of albums to deliver as zip files')
+    parser.add_argument('--workers', type=int, default=0, help='conversion workers for end-to-end (0 = CPU count)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage (min/median/max are reported)')
+    parser.add_argument('--workdir', help='generate the corpus here instead of a temp dir (kept afterwards)')
+    parser.add_argument('--keep', action='store_true', help='keep the temp corpus after the run')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the JSON results')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = bench(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for name, stage in results['stages'].items():
+        print(f"[BENCH] {name:<36} median {stage['median']:.3f}s")
+    print(f"[BENCH] Results written to {args.output}")
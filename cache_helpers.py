@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+class ProbeCache:
+    """
+    On-disk cache of per-file facts (metadata, audio properties, audio hashes).
+    Entries are keyed by (path, kind) and stamped with the file's size and mtime_ns;
+    a stamp mismatch counts as a miss and the entry is recomputed. The oldest
+    entries by last access are evicted once the cache holds more than max_entries;
+    hits only note their access time in memory, and the notes are written out in
+    batches with the next write, eviction or close.
+    Facts about a file whose final path isn't known yet (an import the Music app
+    will move into the library) can be stashed under its stamp and claimed by
+    whatever path the file turns up at.
+    """
+
+    # Stashed facts nobody claimed within this many seconds are dropped
+    STASH_TTL = 30 * 86400
+    # Pending access times are written once this many have piled up
+    ACCESS_FLUSH_EVERY = 256
+
+    def __init__(self, db_path, max_entries=100000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.puts = 0
+        self.accessed = {}
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS probe_cache ('
+            ' path TEXT NOT NULL,'
+            ' kind TEXT NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' value TEXT NOT NULL,'
+            ' last_access REAL NOT NULL,'
+            ' PRIMARY KEY (path, kind))'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS probe_cache_access ON probe_cache (last_access)')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS probe_stash ('
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' kind TEXT NOT NULL,'
+            ' value TEXT NOT NULL,'
+            ' created REAL NOT NULL,'
+            ' PRIMARY KEY (size, mtime_ns, kind))'
+        )
+        self.conn.execute('DELETE FROM probe_stash WHERE created < ?', (time.time() - self.STASH_TTL,))
+        self._evict()
+        self.conn.commit()
+
+    @staticmethod
+    def stamp(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def _lookup(self, path, kind):
+        """The stored value for the current version of the file as JSON text, or None; the caller holds the lock"""
+        try:
+            size, mtime_ns = self.stamp(path)
+        except OSError:
+            return None
+        row = self.conn.execute(
+            'SELECT size, mtime_ns, value FROM probe_cache WHERE path = ? AND kind = ?',
+            (path, kind)
+        ).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return None
+        return row[2]
+
+    def get(self, path, kind):
+        """Return (found, value) for the current version of the file."""
+        with self.lock:
+            value = self._lookup(path, kind)
+            if value is None:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self.accessed[(path, kind)] = time.time()
+            if len(self.accessed) >= self.ACCESS_FLUSH_EVERY:
+                self._flush_access()
+                self.conn.commit()
+        return True, json.loads(value)
+
+    def peek(self, path, kind):
+        """get() that leaves the hit/miss counts and the access time alone, for checking what is already known"""
+        with self.lock:
+            value = self._lookup(path, kind)
+        return (False, None) if value is None else (True, json.loads(value))
+
+    def put(self, path, kind, value, stamp=None):
+        """Store a value for the current version of the file (or for an explicit (size, mtime_ns) stamp)."""
+        try:
+            size, mtime_ns = stamp if stamp is not None else self.stamp(path)
+        except OSError:
+            return
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO probe_cache (path, kind, size, mtime_ns, value, last_access)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (path, kind, size, mtime_ns, json.dumps(value), time.time())
+            )
+            self.accessed.pop((path, kind), None)
+            self._flush_access()
+            self.puts += 1
+            # Counting rows is a table scan, so only enforce the cap periodically
+            if self.puts % 256 == 0:
+                self._evict()
+            self.conn.commit()
+
+    def get_or_compute(self, path, kind, compute):
+        found, value = self.get(path, kind)
+        if found:
+            return value
+        # Stamp before computing so a file changing mid-probe is not cached as the new version
+        try:
+            stamp = self.stamp(path)
+        except OSError:
+            stamp = None
+        value = compute(path)
+        if stamp is not None:
+            self.put(path, kind, value, stamp)
+        return value
+
+    def stash(self, stamp, kind, value):
+        """Keep a value for whichever file turns up with this (size, mtime_ns) stamp; see claim()"""
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO probe_stash (size, mtime_ns, kind, value, created) VALUES (?, ?, ?, ?, ?)',
+                (stamp[0], stamp[1], kind, json.dumps(value), time.time())
+            )
+            self.conn.commit()
+
+    def claim(self, path, kind):
+        """Move a value stashed under the file's current stamp onto the file itself; returns it, or None"""
+        try:
+            size, mtime_ns = self.stamp(path)
+        except OSError:
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT value FROM probe_stash WHERE size = ? AND mtime_ns = ? AND kind = ?',
+                (size, mtime_ns, kind)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                'DELETE FROM probe_stash WHERE size = ? AND mtime_ns = ? AND kind = ?', (size, mtime_ns, kind))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO probe_cache (path, kind, size, mtime_ns, value, last_access)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (path, kind, size, mtime_ns, row[0], time.time())
+            )
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def invalidate(self, path):
+        with self.lock:
+            self.conn.execute('DELETE FROM probe_cache WHERE path = ?', (path,))
+            self.conn.commit()
+
+    def _flush_access(self):
+        """Write the access times noted by get(); the caller commits"""
+        if not self.accessed:
+            return
+        self.conn.executemany(
+            'UPDATE probe_cache SET last_access = ? WHERE path = ? AND kind = ?',
+            [(t, path, kind) for (path, kind), t in self.accessed.items()]
+        )
+        self.accessed.clear()
+
+    def _evict(self):
+        self._flush_access()
+        count = self.conn.execute('SELECT COUNT(*) FROM probe_cache').fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self.conn.execute(
+                'DELETE FROM probe_cache WHERE rowid IN'
+                ' (SELECT rowid FROM probe_cache ORDER BY last_access LIMIT ?)',
+                (excess,)
+            )
+            self.evictions += excess
+
+    def trim(self):
+        """Enforce the size cap now (called on shutdown)."""
+        with self.lock:
+            self._evict()
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits / total) if total else 0.0,
+            }
+
+    def close(self):
+        with self.lock:
+            self._flush_access()
+            self.conn.commit()
+            self.conn.close()
+
+
+class IngestJournal:
+    """
+    Persistent record of which download files have been ingested. Each entry holds
+    the (size, mtime_ns) stamp of the version that was handled and its state:
+    'queued' while a job is in flight, then 'done', 'duplicate' or 'failed'.
+    Restarts skip versions that are already done and resume jobs left 'queued'.
+    """
+
+    SETTLED_STATES = ('done', 'duplicate')
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.run_id = f"{os.getpid()}-{time.time()}"
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS ingest_journal ('
+            ' path TEXT PRIMARY KEY,'
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' state TEXT NOT NULL,'
+            ' run_id TEXT NOT NULL,'
+            ' updated REAL NOT NULL)'
+        )
+        self.conn.commit()
+
+    def is_settled(self, path, stamp):
+        """True if this version of the file is done, or already queued by this run"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime_ns, state, run_id FROM ingest_journal WHERE path = ?', (path,)
+            ).fetchone()
+        if row is None or (row[0], row[1]) != tuple(stamp):
+            return False
+        return row[2] in self.SETTLED_STATES or (row[2] == 'queued' and row[3] == self.run_id)
+
+    def mark(self, path, stamp, state):
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO ingest_journal (path, size, mtime_ns, state, run_id, updated)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (path, stamp[0], stamp[1], state, self.run_id, time.time())
+            )
+            self.conn.commit()
+
+    def finish(self, path, state):
+        """Record the outcome of a queued job (the file itself may be gone by now)"""
+        with self.lock:
+            self.conn.execute(
+                'UPDATE ingest_journal SET state = ?, run_id = ?, updated = ? WHERE path = ?',
+                (state, self.run_id, time.time(), path)
+            )
+            self.conn.commit()
+
+    def in_flight(self):
+        """Paths that a previous run queued but never finished"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT path FROM ingest_journal WHERE state = 'queued' AND run_id != ? ORDER BY updated",
+                (self.run_id,)
+            )]
+
+    def counts(self):
+        """{state: number of files} over the whole journal"""
+        with self.lock:
+            return dict(self.conn.execute('SELECT state, COUNT(*) FROM ingest_journal GROUP BY state'))
+
+    def prune(self, exists):
+        """Drop entries whose file no longer exists (imported files are moved away)"""
+        with self.lock:
+            paths = [row[0] for row in self.conn.execute('SELECT path FROM ingest_journal')]
+        gone = [p for p in paths if not exists(p)]
+        with self.lock:
+            self.conn.executemany('DELETE FROM ingest_journal WHERE path = ?', [(p,) for p in gone])
+            self.conn.commit()
+        return len(gone)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,312 @@
+import os
+import csv
+import json
+import time
+import logging
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from probe_helpers import probe
+from file_helpers import compute_audio_hash, AUDIO_HASH_VERSION
+from index_helpers import iter_library, normalize_tag
+
+logger = logging.getLogger(__name__)
+
+MODE_HASH = 'hash'
+MODE_FINGERPRINT = 'fingerprint'
+# Tracks in one bucket whose durations are further apart than this are never compared
+DURATION_TOLERANCE = 2.0
+# Scan results are committed in batches this large, so an interrupted scan loses little
+CHECKPOINT_EVERY = 500
+# Buckets are read back from SQLite a page at a time
+BUCKET_PAGE_SIZE = 500
+LOSSLESS_CODECS = {'alac', 'flac', 'pcm', 'wavpack', 'ape', 'tta', 'mlp', 'truehd'}
+REPORT_FIELDS = ['group', 'keeper', 'path', 'codec', 'sample_rate', 'bitrate', 'duration', 'size']
+
+
+def bucket_key(info):
+    """
+    Cheap key that every duplicate of a track shares: normalized artist and title when
+    the track is tagged, otherwise its duration in whole seconds, or failing that its size.
+    """
+    title = normalize_tag(info.tag('title'))
+    if title:
+        return 'tags\x1f' + normalize_tag(info.tag('artist')) + '\x1f' + title
+    if info.duration is not None:
+        return f'duration\x1f{int(round(info.duration))}'
+    return f'size\x1f{info.size}'
+
+
+def _scan_file(path):
+    """Process pool worker: the facts bucketing and the keeper choice need, or None"""
+    try:
+        info = probe(path)
+    except Exception as e:
+        logger.debug("Could not probe %s: %s", os.path.basename(path), e)
+        return path, None
+    return path, (info.size, info.mtime_ns, bucket_key(info), info.duration,
+                  info.codec, info.bitrate, info.sample_rate)
+
+
+def _digest_file(task):
+    """Process pool worker: exact PCM hash or encoded chroma fingerprint of one file"""
+    path, mode = task
+    try:
+        if mode == MODE_FINGERPRINT:
+            from fingerprint_helpers import compute_fingerprint, encode_fingerprint
+            return path, encode_fingerprint(compute_fingerprint(path))
+        return path, compute_audio_hash(path)
+    except Exception as e:
+        logger.debug("Could not %s %s: %s", mode, os.path.basename(path), e)
+        return path, ''
+
+
+def _bounded_map(executor, fn, items, limit):
+    """executor.map() that keeps at most `limit` tasks in flight and yields results as they finish"""
+    pending = set()
+    for item in items:
+        pending.add(executor.submit(fn, item))
+        if len(pending) >= limit:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    for future in pending:
+        yield future.result()
+
+
+def is_lossless(codec):
+    codec = (codec or '').lower()
+    return codec in LOSSLESS_CODECS or codec.startswith('pcm')
+
+
+def quality_key(row):
+    """Sort key for choosing which copy to keep: lossless, then sample rate, bitrate and size"""
+    codec, sample_rate, bitrate, size = row['codec'], row['sample_rate'], row['bitrate'], row['size']
+    return (is_lossless(codec), sample_rate or 0, bitrate or 0, size or 0)
+
+
+def duration_clusters(rows):
+    """Split one bucket's rows into runs whose neighbouring durations are within DURATION_TOLERANCE"""
+    timed = sorted((r for r in rows if r['duration'] is not None), key=lambda r: r['duration'])
+    clusters = []
+    for row in timed:
+        if clusters and row['duration'] - clusters[-1][-1]['duration'] <= DURATION_TOLERANCE:
+            clusters[-1].append(row)
+        else:
+            clusters.append([row])
+    untimed = [r for r in rows if r['duration'] is None]
+    if untimed:
+        clusters.append(untimed)
+    return [c for c in clusters if len(c) > 1]
+
+
+class DedupeScan:
+    """
+    Find duplicate tracks in a library folder.
+    Every file is probed once (in a process pool) and its facts are checkpointed to
+    SQLite, so an interrupted scan picks up where it stopped and a rerun only reads
+    files that changed. Files are bucketed by cheap facts first; only tracks that
+    share a bucket and a duration are hashed or fingerprinted, and buckets are read
+    back a page at a time, so memory stays flat however large the library is.
+    """
+
+    def __init__(self, library_folder, db_path, supported_extensions, workers=None,
+                 mode=MODE_HASH, threshold=0.8):
+        self.library_folder = os.path.normpath(library_folder)
+        self.supported_extensions = supported_extensions
+        self.workers = workers or os.cpu_count() or 1
+        self.mode = mode
+        self.threshold = threshold
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS dedupe_scan ('
+            ' path TEXT PRIMARY KEY,'
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' bucket TEXT,'
+            ' duration REAL,'
+            ' codec TEXT,'
+            ' bitrate INTEGER,'
+            ' sample_rate INTEGER,'
+            ' audio_hash TEXT,'
+            ' fingerprint TEXT,'
+            ' seen INTEGER NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS dedupe_scan_bucket ON dedupe_scan (bucket)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS dedupe_state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        row = self.conn.execute("SELECT value FROM dedupe_state WHERE key = 'audio_hash_version'").fetchone()
+        if row is None or row[0] != AUDIO_HASH_VERSION:
+            # Hashes of an older PCM format never match new ones
+            self.conn.execute('UPDATE dedupe_scan SET audio_hash = NULL')
+            self.conn.execute("INSERT OR REPLACE INTO dedupe_state VALUES ('audio_hash_version', ?)", (AUDIO_HASH_VERSION,))
+        self.conn.commit()
+
+    def reset(self):
+        """Forget all checkpointed progress"""
+        self.conn.execute('DELETE FROM dedupe_scan')
+        self.conn.execute("DELETE FROM dedupe_state WHERE key != 'audio_hash_version'")
+        self.conn.commit()
+
+    def _next_generation(self):
+        row = self.conn.execute("SELECT value FROM dedupe_state WHERE key = 'generation'").fetchone()
+        generation = (row[0] if row else 0) + 1
+        self.conn.execute("INSERT OR REPLACE INTO dedupe_state VALUES ('generation', ?)", (generation,))
+        self.conn.commit()
+        return generation
+
+    def _changed_files(self, generation, counts):
+        """Walk the library, marking unchanged files as seen and yielding the paths that need probing"""
+        for path, st in iter_library(self.library_folder, self.supported_extensions):
+            counts['files'] += 1
+            row = self.conn.execute('SELECT size, mtime_ns FROM dedupe_scan WHERE path = ?', (path,)).fetchone()
+            if row and row['size'] == st.st_size and row['mtime_ns'] == st.st_mtime_ns:
+                self.conn.execute('UPDATE dedupe_scan SET seen = ? WHERE path = ?', (generation, path))
+                counts['cached'] += 1
+                if counts['files'] % CHECKPOINT_EVERY == 0:
+                    self.conn.commit()
+                continue
+            yield path
+
+    def scan(self, executor):
+        """Probe new and changed library files and drop rows for files that are gone"""
+        generation = self._next_generation()
+        counts = {'files': 0, 'cached': 0, 'probed': 0, 'unreadable': 0}
+        started = time.monotonic()
+        for path, facts in _bounded_map(executor, _scan_file, self._changed_files(generation, counts), self.workers * 4):
+            if facts is None:
+                counts['unreadable'] += 1
+                self.conn.execute('DELETE FROM dedupe_scan WHERE path = ?', (path,))
+                continue
+            self.conn.execute(
+                'INSERT OR REPLACE INTO dedupe_scan VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL, ?)',
+                (path,) + facts + (generation,))
+            counts['probed'] += 1
+            if counts['probed'] % CHECKPOINT_EVERY == 0:
+                self.conn.commit()
+                logger.info("Scanned %s file(s) (%s probed, %.0fs)", counts['files'], counts['probed'],
+                            time.monotonic() - started)
+        counts['removed'] = self.conn.execute('DELETE FROM dedupe_scan WHERE seen != ?', (generation,)).rowcount
+        self.conn.commit()
+        logger.info("Library scan done: %s", counts)
+        return counts
+
+    def _colliding_buckets(self):
+        """Yield the rows of each bucket holding more than one file, one page of buckets at a time"""
+        last = ''
+        while True:
+            buckets = [r[0] for r in self.conn.execute(
+                'SELECT bucket FROM dedupe_scan WHERE bucket > ? GROUP BY bucket HAVING COUNT(*) > 1'
+                ' ORDER BY bucket LIMIT ?', (last, BUCKET_PAGE_SIZE))]
+            if not buckets:
+                return
+            for bucket in buckets:
+                yield self.conn.execute('SELECT * FROM dedupe_scan WHERE bucket = ?', (bucket,)).fetchall()
+            last = buckets[-1]
+
+    @property
+    def _digest_column(self):
+        return 'fingerprint' if self.mode == MODE_FINGERPRINT else 'audio_hash'
+
+    def _undigested(self):
+        column = self._digest_column
+        for rows in self._colliding_buckets():
+            for cluster in duration_clusters(rows):
+                for row in cluster:
+                    if row[column] is None:
+                        yield row['path'], self.mode
+
+    def digest(self, executor):
+        """Hash or fingerprint the files that share a bucket with another file and lack one"""
+        column = self._digest_column
+        done = 0
+        for path, value in _bounded_map(executor, _digest_file, self._undigested(), self.workers * 4):
+            self.conn.execute(f'UPDATE dedupe_scan SET {column} = ? WHERE path = ?', (value, path))
+            done += 1
+            if done % CHECKPOINT_EVERY == 0:
+                self.conn.commit()
+                logger.info("Computed %s %s(s)", done, self.mode)
+        self.conn.commit()
+        logger.info("Computed %s %s(s) for colliding buckets", done, self.mode)
+        return done
+
+    def _matching_groups(self, cluster):
+        """Split one duration cluster into sets of files with the same audio"""
+        column = self._digest_column
+        rows = [r for r in cluster if r[column]]
+        if self.mode != MODE_FINGERPRINT:
+            by_hash = {}
+            for row in rows:
+                by_hash.setdefault(row[column], []).append(row)
+            return [group for group in by_hash.values() if len(group) > 1]
+        from fingerprint_helpers import decode_fingerprint, fingerprint_similarity
+        prints = [decode_fingerprint(r[column]) for r in rows]
+        parent = list(range(len(rows)))
+
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        for i in range(len(rows)):
+            for j in range(i + 1, len(rows)):
+                if root(i) != root(j) and fingerprint_similarity(prints[i], prints[j]) >= self.threshold:
+                    parent[root(j)] = root(i)
+        groups = {}
+        for i, row in enumerate(rows):
+            groups.setdefault(root(i), []).append(row)
+        return [group for group in groups.values() if len(group) > 1]
+
+    def groups(self):
+        """Yield each duplicate group as a list of rows, best copy first"""
+        for rows in self._colliding_buckets():
+            for cluster in duration_clusters(rows):
+                for group in self._matching_groups(cluster):
+                    yield sorted(group, key=quality_key, reverse=True)
+
+    def run(self):
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            self.scan(executor)
+            self.digest(executor)
+
+    def close(self):
+        self.conn.close()
+
+
+def _report_entry(rows):
+    return [{field: row[field] for field in REPORT_FIELDS[2:]} for row in rows]
+
+
+def write_report(groups, report_path, report_format=None):
+    """
+    Stream duplicate groups to a JSON or CSV report (format taken from the extension
+    unless given). The first file of each group is the suggested keeper.
+    Returns (groups, redundant files, bytes they take up).
+    """
+    report_format = report_format or ('csv' if report_path.lower().endswith('.csv') else 'json')
+    total_groups = redundant = reclaimable = 0
+    tmp = f"{report_path}.tmp"
+    with open(tmp, 'w', newline='') as f:
+        if report_format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(REPORT_FIELDS)
+        else:
+            f.write('[\n')
+        for rows in groups:
+            total_groups += 1
+            redundant += len(rows) - 1
+            reclaimable += sum(row['size'] for row in rows[1:])
+            entries = _report_entry(rows)
+            if report_format == 'csv':
+                for i, entry in enumerate(entries):
+                    writer.writerow([total_groups, 'yes' if i == 0 else ''] + [entry[k] for k in REPORT_FIELDS[2:]])
+            else:
+                if total_groups > 1:
+                    f.write(',\n')
+                json.dump({'group': total_groups, 'keeper': entries[0]['path'], 'files': entries}, f)
+        if report_format != 'csv':
+            f.write('\n]\n')
+    os.replace(tmp, report_path)
+    return total_groups, redundant, reclaimable
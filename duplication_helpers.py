@@ -1,14 +1,19 @@
 import os
-from file_helpers import extract_metadata, extract_audio_properties, compute_audio_hash
+import logging
+from file_helpers import extract_metadata, extract_audio_properties, hash_audio_stream, audio_matches_digests, PCM_DIGESTS_KIND
+from probe_helpers import probe
+from fingerprint_helpers import cached_fingerprint, fingerprint_similarity, DEFAULT_THRESHOLD
 
-def construct_audio_dest(library_folder, new_file, ext):
+logger = logging.getLogger(__name__)
+
+def construct_audio_dest(library_folder, new_file, ext, info=None):
     """
     Construct the expected destination path for a file based on its metadata and extension.
     """
     # Retrieve metadata for constructing expected audio file destination
 
     path_metafields = ['artist', 'album', 'title', 'discnumber', 'tracknumber'] 
-    metadata = extract_metadata(new_file, path_metafields)
+    metadata = extract_metadata(new_file, path_metafields, info)
     artist = metadata.get('artist') 
     album = metadata.get('album') 
     title = metadata.get('title') 
@@ -49,63 +54,101 @@ def construct_audio_dest(library_folder, new_file, ext):
     return constructed_path
 
 
-def is_duplicate(new_file, existing_file, dup_criteria):
+def _library_facts(existing_file, kind, compute, cache):
+    """Look up a fact about a library file in the probe cache, computing it on a miss"""
+    if cache is None:
+        return compute(existing_file)
+    return cache.get_or_compute(existing_file, kind, compute)
+
+
+def fingerprint_criteria(dup_criteria):
+    """(enabled, threshold) of the AUDIO_FINGERPRINT criterion: YES/NO or a dict with ENABLED and THRESHOLD"""
+    value = dup_criteria.get('AUDIO_FINGERPRINT', False)
+    if isinstance(value, dict):
+        return value.get('ENABLED', False) is True, float(value.get('THRESHOLD', DEFAULT_THRESHOLD))
+    return value is True, DEFAULT_THRESHOLD
+
+
+def is_duplicate(new_file, existing_file, dup_criteria, cache=None, new_info=None, new_digests=None):
     """
     Create expected path of potential duplicate and compare metadata 
-    and audio properties with the newly downloaded audio file
+    and audio properties with the newly downloaded audio file.
+    Facts about the existing library file are read through `cache` when one is given;
+    `new_info` is the MediaProbe of the new file and `new_digests` its audio hash,
+    if the caller already has them.
     """
 
     # Metafields and audio property fields for duplicate checking
     dup_metafields = [k for k, v in dup_criteria.get('METADATA', {}).items() if v is True]
     dup_propfields = [k for k, v in dup_criteria.get('AUDIO_PROPERTIES', {}).items() if v is True]
     use_hash = dup_criteria.get('AUDIO_HASH', False) is True
+    use_fingerprint, fingerprint_threshold = fingerprint_criteria(dup_criteria)
 
     # If hash is enabled, only compare hashes and skip all other checks
     if use_hash:
-        new_hash = compute_audio_hash(new_file)
-        exist_hash = compute_audio_hash(existing_file)
-        print(f"[DEBUG] Comparing audio_hash only: new='{new_hash}', existing='{exist_hash}'")
-        if new_hash == exist_hash:
-            print("[DEBUG] Files are considered duplicates (hash match).")
+        exist_hash, exist_chunks = _library_facts(existing_file, PCM_DIGESTS_KIND, hash_audio_stream, cache)
+        logger.debug("Comparing audio_hash only against existing='%s'", exist_hash)
+        if new_digests is not None:
+            matched = new_digests[0] == exist_hash
+        else:
+            matched = audio_matches_digests(new_file, exist_chunks)
+        if matched:
+            logger.debug("Files are considered duplicates (hash match).")
             return True
         else:
-            print("[DEBUG] Files are NOT duplicates (hash mismatch).")
+            logger.debug("Files are NOT duplicates (hash mismatch).")
+            return False
+
+    # Likewise for acoustic fingerprints, which also match other rips and lossy copies
+    if use_fingerprint:
+        try:
+            exist_fp = cached_fingerprint(existing_file, cache)
+            new_fp = cached_fingerprint(new_file, cache)
+        except ValueError as e:
+            # Undecodable or too short to fingerprint: can't be shown to be a duplicate
+            logger.debug("No fingerprint comparison possible: %s", e)
             return False
+        similarity = fingerprint_similarity(new_fp, exist_fp)
+        logger.debug("Fingerprint similarity %.3f (threshold %.3f) against existing='%s'",
+                     similarity, fingerprint_threshold, existing_file)
+        return similarity >= fingerprint_threshold
 
     # Otherwise, compare metadata and/or properties 
-    existing_info = {'metadata': extract_metadata(existing_file, dup_metafields)}
+    existing_probe = probe(existing_file, cache)
+    existing_info = {'metadata': extract_metadata(existing_file, dup_metafields, existing_probe)}
     if dup_propfields:
-        existing_info['audio_properties'] = extract_audio_properties(existing_file, dup_propfields)
+        existing_info['audio_properties'] = extract_audio_properties(existing_file, dup_propfields, existing_probe)
 
-    new_file_info = {'metadata': extract_metadata(new_file, dup_metafields)}
+    new_info = new_info or probe(new_file)
+    new_file_info = {'metadata': extract_metadata(new_file, dup_metafields, new_info)}
     if dup_propfields:
-        new_file_info['audio_properties'] = extract_audio_properties(new_file, dup_propfields)
+        new_file_info['audio_properties'] = extract_audio_properties(new_file, dup_propfields, new_info)
 
-    print("[DEBUG] is_duplicate: comparing new_file_info and existing_info")
-    print(f"[DEBUG] new_file_info: {new_file_info}")
-    print(f"[DEBUG] existing_info: {existing_info}")
+    logger.debug("is_duplicate: comparing new_file_info and existing_info")
+    logger.debug("new_file_info: %s", new_file_info)
+    logger.debug("existing_info: %s", existing_info)
 
     match = True
     for field in dup_metafields:
         new_val = new_file_info['metadata'].get(field)
         exist_val = existing_info['metadata'].get(field)
-        print(f"[DEBUG] Comparing metadata field '{field}': new='{new_val}' ({type(new_val)}), existing='{exist_val}' ({type(exist_val)})")
+        logger.debug("Comparing metadata field '%s': new='%s' (%s), existing='%s' (%s)", field, new_val, type(new_val), exist_val, type(exist_val))
         if new_val != exist_val:
-            print(f"[DEBUG] MISMATCH on metadata field '{field}'")
+            logger.debug("MISMATCH on metadata field '%s'", field)
             match = False
             break
     if match and dup_propfields:
         for field in dup_propfields:
             new_val = new_file_info['audio_properties'].get(field.upper())
             exist_val = existing_info.get('audio_properties', {}).get(field.upper())
-            print(f"[DEBUG] Comparing audio property '{field.upper()}': new='{new_val}' ({type(new_val)}), existing='{exist_val}' ({type(exist_val)})")
+            logger.debug("Comparing audio property '%s': new='%s' (%s), existing='%s' (%s)", field.upper(), new_val, type(new_val), exist_val, type(exist_val))
             if new_val != exist_val:
-                print(f"[DEBUG] MISMATCH on audio property '{field.upper()}'")
+                logger.debug("MISMATCH on audio property '%s'", field.upper())
                 match = False
                 break
     if match:
-        print("[DEBUG] Files are considered duplicates.")
+        logger.debug("Files are considered duplicates.")
         return True
-    print("[DEBUG] Files are NOT duplicates.")
+    logger.debug("Files are NOT duplicates.")
     return False
 
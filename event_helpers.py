@@ -0,0 +1,341 @@
+import os
+import math
+import stat
+import shutil
+import logging
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def collapse_paths(paths):
+    """
+    Deduplicate paths and drop any path that lives inside another path in the set,
+    since processing the parent directory already covers its children.
+    """
+    unique = {os.path.normpath(p) for p in paths}
+    result = []
+    for path in sorted(unique):
+        child, parent = path, os.path.dirname(path)
+        covered = False
+        while parent and parent != child:
+            if parent in unique:
+                covered = True
+                break
+            child, parent = parent, os.path.dirname(parent)
+        if not covered:
+            result.append(path)
+    return result
+
+
+class EventCoalescer:
+    """
+    Collect filesystem event paths and release them as one consolidated batch once
+    no new event has arrived for `settle` seconds (or `max_wait` seconds have passed
+    since the first event of the batch, so a steady stream cannot starve it).
+    One long-lived thread waits for the batch's deadline; add() only records the path
+    and the time, so a storm of events costs no thread or timer per event.
+    """
+
+    def __init__(self, on_batch, settle=1.0, max_wait=10.0):
+        self.on_batch = on_batch
+        self.settle = settle
+        self.max_wait = max(settle, max_wait)
+        self.lock = threading.Condition()
+        self.paths = set()
+        self.first_event = None
+        self.last_event = None
+        self.stopped = False
+        self.raw_events = 0
+        self.batches = 0
+        self.jobs = 0
+        self.thread = threading.Thread(target=self._run, name='event-coalescer', daemon=True)
+        self.thread.start()
+
+    def add(self, path):
+        with self.lock:
+            self.raw_events += 1
+            self.paths.add(path)
+            self.last_event = time.monotonic()
+            if self.first_event is None:
+                # Later events only push the deadline back, so only a new batch needs to wake the flusher
+                self.first_event = self.last_event
+                self.lock.notify()
+
+    def _deadline(self):
+        # Callers hold the lock
+        return min(self.last_event + self.settle, self.first_event + self.max_wait)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while True:
+                    if self.stopped:
+                        return
+                    if self.first_event is None:
+                        self.lock.wait()
+                        continue
+                    delay = self._deadline() - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.lock.wait(delay)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Event batch failed: %s", e)
+
+    def flush(self):
+        """Hand all pending paths to the callback as a single collapsed batch."""
+        with self.lock:
+            pending = self.paths
+            self.paths = set()
+            self.first_event = None
+            self.last_event = None
+            if not pending:
+                return
+            batch = collapse_paths(pending)
+            self.batches += 1
+            self.jobs += len(batch)
+        logger.info("Coalesced %s event path(s) into %s job(s)", len(pending), len(batch))
+        self.on_batch(batch)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'raw_events': self.raw_events,
+                'batches': self.batches,
+                'jobs': self.jobs,
+                'pending': len(self.paths),
+            }
+
+    def stop(self):
+        """Stop the flusher thread and hand over whatever is still pending"""
+        with self.lock:
+            self.stopped = True
+            self.lock.notify()
+        self.thread.join()
+        self.flush()
+
+
+def tree_stamp(path):
+    """
+    (total size, latest mtime_ns, file count) of a file, or of all files under a folder,
+    so any write anywhere in a download changes it. None if the path is gone.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size, st.st_mtime_ns, 1
+    total, latest, count = 0, st.st_mtime_ns, 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                file_st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            total += file_st.st_size
+            latest = max(latest, file_st.st_mtime_ns)
+            count += 1
+    return total, latest, count
+
+
+def open_elsewhere(paths, lsof):
+    """The subset of paths lsof reports a process holding open, from one lsof run (empty if it can't tell)"""
+    try:
+        proc = subprocess.run([lsof, '-F', 'n', '--'] + list(paths), stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return set()
+    # Exit status 1 only means some file isn't open; the name lines list the ones that are
+    names = {line[1:] for line in proc.stdout.decode(errors='replace').splitlines() if line.startswith('n')}
+    return {p for p in paths if p in names or os.path.realpath(p) in names}
+
+
+class _Pending:
+    __slots__ = ('stamp', 'stable_since', 'first_seen', 'due')
+
+    def __init__(self, now):
+        self.stamp = None
+        self.stable_since = now
+        self.first_seen = now
+        self.due = 0
+
+
+class StabilityTracker:
+    """
+    Hold new download paths until they stop changing, then hand them to `on_stable`.
+    Downloaders that write the final filename incrementally fire the created event
+    long before the file is complete, so a path is only released once its size and
+    mtime (summed over the tree, for folders) have been unchanged for `quiet` seconds
+    and, where lsof is available, no process still has the file open.
+    Pending paths sit on a hashed timer wheel turned by one thread: each tick only
+    looks at the paths due in that slot, so thousands of files being written need no
+    thread or sleep of their own. The files that settle in one tick are checked with
+    a single lsof run on a separate thread, so a slow lsof never holds up the wheel.
+    """
+
+    def __init__(self, on_stable, quiet=5.0, interval=1.0, max_wait=0, check_open=True, tick=0.25, slots=256):
+        self.on_stable = on_stable
+        self.quiet = quiet
+        self.tick = tick
+        self.interval = max(interval, tick)
+        self.max_wait = max_wait
+        self.lsof = shutil.which('lsof') if check_open else None
+        self.lock = threading.Lock()
+        self.wheel = [set() for _ in range(slots)]
+        self.entries = {}  # path -> _Pending
+        self.current_tick = 0
+        self.released = 0
+        self.held_open = 0
+        self.abandoned = 0
+        self.stopped = threading.Event()
+        self.open_checks = ThreadPoolExecutor(1, thread_name_prefix='stability-lsof') if self.lsof else None
+        self.thread = threading.Thread(target=self._run, name='stability-tracker', daemon=True)
+        self.thread.start()
+
+    def _schedule(self, path, entry, delay):
+        # Callers hold the lock
+        entry.due = self.current_tick + max(1, int(math.ceil(delay / self.tick)))
+        self.wheel[entry.due % len(self.wheel)].add(path)
+
+    def _covered(self, path):
+        parent = os.path.dirname(path)
+        while parent and parent != path:
+            if parent in self.entries:
+                return True
+            path, parent = parent, os.path.dirname(parent)
+        return False
+
+    def add(self, path):
+        """Start watching a new path (or restart the quiet period of one already watched)"""
+        path = os.path.normpath(path)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                entry.stable_since = now
+                return
+            if self._covered(path):
+                return  # the folder it is in is already being watched
+            entry = self.entries[path] = _Pending(now)
+            self._schedule(path, entry, self.interval)
+
+    def touch(self, path):
+        """A watched path was written to: restart its quiet period"""
+        path = os.path.normpath(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                entry.stable_since = time.monotonic()
+
+    def _check(self, path):
+        """Re-stamp a due path; returns True once it has been quiet long enough to release"""
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is None:
+            return False
+        stamp = tree_stamp(path)
+        now = time.monotonic()
+        release = False
+        with self.lock:
+            if stamp is None:
+                # Deleted or moved away before it settled
+                self.entries.pop(path, None)
+                return False
+            if stamp != entry.stamp:
+                entry.stamp = stamp
+                entry.stable_since = now
+            elif now - entry.stable_since >= self.quiet:
+                release = True
+            if not release:
+                if self.max_wait and now - entry.first_seen > self.max_wait:
+                    self.entries.pop(path, None)
+                    self.abandoned += 1
+                    logger.warning("%s is still changing after %ss; leaving it for the next start",
+                                   os.path.basename(path), int(self.max_wait))
+                    return False
+                remaining = self.quiet - (now - entry.stable_since)
+                self._schedule(path, entry, min(self.interval, max(remaining, self.tick)))
+        return release
+
+    def _release(self, path):
+        with self.lock:
+            if self.entries.pop(path, None) is None:
+                return
+            self.released += 1
+        logger.debug("Download settled: %s", os.path.basename(path))
+        self.on_stable(path)
+
+    def _check_open(self, paths):
+        """Release the settled files no other process has open; re-arm the rest"""
+        held = open_elsewhere(paths, self.lsof)
+        now = time.monotonic()
+        ready = []
+        with self.lock:
+            for path in paths:
+                entry = self.entries.get(path)
+                if entry is None:
+                    continue
+                if path in held:
+                    self.held_open += 1
+                    self._schedule(path, entry, self.interval)
+                elif now - entry.stable_since < self.quiet:
+                    # Written to again while lsof ran
+                    self._schedule(path, entry, self.interval)
+                else:
+                    ready.append(path)
+        for path in ready:
+            self._release(path)
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self.stopped.is_set():
+            next_tick += self.tick
+            delay = next_tick - time.monotonic()
+            if delay > 0 and self.stopped.wait(delay):
+                return
+            with self.lock:
+                self.current_tick += 1
+                slot = self.wheel[self.current_tick % len(self.wheel)]
+                due = [p for p in slot if p in self.entries and self.entries[p].due <= self.current_tick]
+                slot.difference_update(due)
+            files = []
+            for path in due:
+                try:
+                    if not self._check(path):
+                        continue
+                    if self.open_checks is not None and not os.path.isdir(path):
+                        files.append(path)
+                    else:
+                        self._release(path)
+                except Exception as e:
+                    logger.error("Stability check failed for %s: %s", path, e)
+            if files:
+                self.open_checks.submit(self._guarded_check_open, files)
+
+    def _guarded_check_open(self, paths):
+        try:
+            self._check_open(paths)
+        except Exception as e:
+            logger.error("Open file check failed: %s", e)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': len(self.entries),
+                'released': self.released,
+                'held_open': self.held_open,
+                'abandoned': self.abandoned,
+            }
+
+    def stop(self):
+        """Stop the wheel; paths still settling are left for the next start's initial scan"""
+        self.stopped.set()
+        self.thread.join()
+        if self.open_checks is not None:
+            self.open_checks.shutdown(wait=True)
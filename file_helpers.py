@@ -1,7 +1,29 @@
-import os 
-import zipfile
+import os
+import time
+import hashlib
+import logging
+import shutil
 from collections import deque
-from mutagen import File as MutagenFile
+from metrics_helpers import metrics
+from probe_helpers import probe, ffprobe_codec
+from zip_helpers import (
+    zip_member_path, split_zip_member_path, list_zip_members, open_zip_member,
+    extract_zip_member, extract_zip_covers, zip_member_stat, UNPIPEABLE_EXTENSIONS
+)
+
+logger = logging.getLogger(__name__)
+
+STAGING_DIR_NAME = '.slsync-staging'
+
+# How a file gets into the library (see conversion_route)
+ROUTE_MOVE = 'move'
+ROUTE_REMUX = 'remux'
+ROUTE_TRANSCODE = 'transcode'
+# ALAC files in these containers go to DEST_FOLDER as they are
+MOVE_EXTENSIONS = {'.m4a'}
+STAGING_SLOT_PREFIX = 'job-'
+# Written into a staging slot once its conversion has finished; holds the source path
+SLOT_DONE_MARKER = '.done'
 
 
 # def find_audio_files(folder, supported_extensions):
@@ -29,77 +51,465 @@ from mutagen import File as MutagenFile
 #     return audio_files
 
 
+def _audio_in_zip(zip_path, supported_extensions):
+    logger.info("Found zip file: %s", os.path.basename(zip_path))
+    try:
+        members, covers = list_zip_members(zip_path, supported_extensions)
+    except Exception as e:
+        logger.error("Failed to read %s: %s", os.path.basename(zip_path), e)
+        return []
+    extract_zip_covers(zip_path, covers)
+    return [zip_member_path(zip_path, name) for name in members]
+
+
 def find_audio_files(path, supported_extensions):
     """
     Find all audio files in a file or folder, including inside subfolders and zip files.
     Accepts either a file or a directory as input.
+    Audio inside zip files is returned as zip member paths ("album.zip!/01 track.flac");
+    the archive itself is never extracted.
+    This is a generator: files are yielded as soon as they are found, so work on the
+    first file can start while the rest of the tree is still being walked.
     """
-    audio_files = []
-    queue = [path]
+    if not os.path.exists(path):
+        return  # Already moved away (e.g. a converted file picked up by its own event)
+    if os.path.isfile(path):
+        if path.lower().endswith('.zip'):
+            yield from _audio_in_zip(path, supported_extensions)
+        elif is_audio_file(path, supported_extensions):
+            yield path
+        return
 
+    queue = deque([path])
     while queue:
-        current = queue.pop(0)
-        if os.path.isdir(current):
-            for entry in sorted(os.listdir(current)):
-                queue.append(os.path.join(current, entry))
-        elif os.path.isfile(current):
-            if current.lower().endswith('.zip'):
-                print(f"[INFO] Found zip file: {os.path.basename(current)}")
-                extract_zip(current)
-                # queue.extend(extracted_files)
-                continue # on_created will re-scan the directory after extraction
-            elif is_audio_file(current, supported_extensions):
-                audio_files.append(current)
-    return audio_files
+        current = queue.popleft()
+        try:
+            with os.scandir(current) as it:
+                entries = list(it)
+        except OSError as e:
+            logger.warning("Could not scan %s: %s", current, e)
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    queue.append(entry.path)
+                elif entry.is_file():
+                    if entry.name.lower().endswith('.zip'):
+                        yield from _audio_in_zip(entry.path, supported_extensions)
+                    elif is_audio_file(entry.name, supported_extensions):
+                        yield entry.path
+            except OSError:
+                continue
+
+
+def path_stamp(path):
+    """Return (size, mtime_ns) identifying the current version of a file or zip member"""
+    if split_zip_member_path(path):
+        return zip_member_stat(path)
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def source_path(path):
+    """The file on disk behind a path: the archive for zip members, else the path itself"""
+    zip_member = split_zip_member_path(path)
+    return zip_member[0] if zip_member else path
 
 
 def is_audio_file(filepath, supported_extensions):
     ext = os.path.splitext(filepath)[1].lower()
     return ext in supported_extensions
 
-def is_alac(filepath):
-    audio = MutagenFile(filepath)
-    if audio and audio.info:
-        return getattr(audio.info, 'codec', None) == 'alac'
+def conversion_route(filepath, info=None):
+    """
+    How much work a file needs to become an ALAC .m4a, from its probe:
+    ROUTE_MOVE if it already is one, ROUTE_REMUX if it is ALAC in another container
+    (only the container is rewritten), ROUTE_TRANSCODE for everything else.
+    Files mutagen couldn't read are asked about with ffprobe.
+    """
+    codec = info.codec if info is not None else None
+    if codec is None and not split_zip_member_path(filepath):
+        codec = ffprobe_codec(filepath)
+    if codec != 'alac':
+        return ROUTE_TRANSCODE
+    if os.path.splitext(filepath)[1].lower() in MOVE_EXTENSIONS:
+        return ROUTE_MOVE
+    return ROUTE_REMUX
+
+def unique_output_path(directory, base, ext):
+    """Return directory/base+ext, adding a counter if that name is taken"""
+    out_path = os.path.join(directory, base + ext)
+    n = 1
+    while os.path.exists(out_path):
+        out_path = os.path.join(directory, f"{base} ({n}){ext}")
+        n += 1
+    return out_path
 
-def convert_to_alac(src):
+def staging_dir_for(dest_folder, staging_folder=None):
+    """
+    Return a staging folder on the same filesystem as dest_folder, where conversions
+    are written before being renamed into place: by default a hidden folder next to
+    dest_folder, so nothing watching dest_folder sees it. Returns None if the folder
+    can't be created there, in which case files are copied in the old way.
+    Slots left behind by an interrupted run are kept for recover_staging_slots().
+    """
+    dest_folder = os.path.abspath(dest_folder)
+    staging = staging_folder or os.path.join(os.path.dirname(dest_folder.rstrip(os.sep)), STAGING_DIR_NAME)
     try:
-        # Convert src to ALAC, output in same directory, same base name, .m4a extension
-        print(f"[INFO] Converting audio file to ALAC format: {src}")
-        base = os.path.splitext(os.path.basename(src))[0]
-        out_path = os.path.join(os.path.dirname(src), base + '.m4a')
-
-        # Build ffmpeg command: encode audio as ALAC, copy video streams if present (as in working shell command)
-        import subprocess
-        cmd = [
-            'ffmpeg',
-            '-y',
-            '-i', src,
-            '-c:a', 'alac',
-            '-c:v', 'copy',
-            out_path
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"[ERROR] ffmpeg error: {result.stderr}")
-            return
-        if os.path.exists(out_path):
-            filename = os.path.basename(src)
-            alac_filename = os.path.basename(out_path)
-            print(f"[SUCCESS] Converted to ALAC: {filename} -> {alac_filename}")
-            os.remove(src)
-            return out_path
+        os.makedirs(staging, exist_ok=True)
+        if os.stat(staging).st_dev != os.stat(dest_folder).st_dev:
+            logger.warning("Staging folder %s is not on the same volume as %s; not using it", staging, dest_folder)
+            return None
+    except OSError as e:
+        logger.warning("Could not create staging folder %s: %s", staging, e)
+        return None
+    return staging
+
+def recover_staging_slots(staging_dir, dest_folder):
+    """
+    Deal with the slots an interrupted run (or a failed publish) left behind. A finished
+    conversion is published to dest_folder and its source removed, as the move would have
+    done; a slot without the done marker holds an unfinished conversion whose source was
+    never touched, so it is dropped. Slots that still can't be published are kept.
+    Returns the source paths whose conversion was published.
+    """
+    recovered = []
+    for entry in os.scandir(staging_dir):
+        if not entry.name.startswith(STAGING_SLOT_PREFIX) or not entry.is_dir(follow_symlinks=False):
+            continue
+        marker = os.path.join(entry.path, SLOT_DONE_MARKER)
+        if not os.path.exists(marker):
+            release_staging_slot(entry.path)
+            continue
+        try:
+            with open(marker) as f:
+                src = f.read()
+            for name in os.listdir(entry.path):
+                if name != SLOT_DONE_MARKER:
+                    publish_file(os.path.join(entry.path, name), dest_folder)
+            remove_source(src)
+        except OSError as e:
+            logger.error("Could not publish leftover conversion in %s: %s", entry.path, e)
+            continue
+        logger.info("Published conversion left over from the last run: %s", os.path.basename(src))
+        release_staging_slot(entry.path)
+        recovered.append(src)
+    return recovered
+
+def new_staging_slot(staging_dir):
+    """A private folder in the staging area for one job's output, so names never collide"""
+    import tempfile
+    return tempfile.mkdtemp(prefix=STAGING_SLOT_PREFIX, dir=staging_dir)
+
+def release_staging_slot(slot):
+    if slot:
+        shutil.rmtree(slot, ignore_errors=True)
+
+def mark_slot_done(slot, src):
+    """Record that the conversion in slot finished, so it survives a crash before it is published"""
+    if slot:
+        with open(os.path.join(slot, SLOT_DONE_MARKER), 'w') as f:
+            f.write(src)
+
+def remove_source(src):
+    """Delete a download once its converted copy is in place (zip members go with their archive)"""
+    if not split_zip_member_path(src) and os.path.exists(src):
+        os.remove(src)
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # some filesystems can't fsync directories
+    finally:
+        os.close(fd)
+
+def publish_file(path, dest_folder, name=None):
+    """
+    Atomically place a finished file in dest_folder (which must be on the same filesystem):
+    flush it to disk, then rename it in, so the Music app never picks up a partial file.
+    Returns the final path; an existing file of the same name is never overwritten.
+    """
+    _fsync(path)
+    base, ext = os.path.splitext(name or os.path.basename(path))
+    final_path = unique_output_path(dest_folder, base, ext)
+    os.replace(path, final_path)
+    _fsync(dest_folder)
+    return final_path
+
+def move_to_dest(src, dest_folder, staging_dir=None, prepare=None):
+    """
+    Move a finished audio file (or zip member) into dest_folder without re-encoding.
+    Files on the destination volume are renamed straight in; anything else is copied
+    into a staging slot on that volume first, so the last step is always an atomic
+    rename. prepare(path) is run on the file just before it is published.
+    """
+    zip_member = split_zip_member_path(src)
+    if not zip_member and os.stat(src).st_dev == os.stat(dest_folder).st_dev:
+        # Same-device fast path: no data is copied
+        if prepare:
+            prepare(src)
+        return publish_file(src, dest_folder)
+    name = os.path.basename(src)
+    if staging_dir is not None:
+        slot = new_staging_slot(staging_dir)
+        staged = os.path.join(slot, name)
+    else:
+        # No staging folder: copy under a hidden name in dest_folder and rename that
+        slot = None
+        staged = unique_output_path(dest_folder, f'.{name}', '.part')
+    try:
+        if zip_member:
+            extract_zip_member(src, staged)
         else:
-            print(f"[ERROR] Conversion failed: output file was not created for {os.path.basename(src)}")
-            return
-    except Exception as e:
-        print(f"[ERROR] Convert failed: {os.path.basename(src)} -> ALAC | {e}")
+            shutil.copyfile(src, staged)
+        if prepare:
+            prepare(staged)
+        final_path = publish_file(staged, dest_folder, name)
+    except BaseException:
+        if os.path.exists(staged):
+            os.remove(staged)
+        raise
+    finally:
+        release_staging_slot(slot)
+    if not zip_member:
+        os.remove(src)
+    return final_path
+
+def feed_zip_member(proc, member_path):
+    """Stream a zip member into a child process's stdin from a background thread"""
+    import threading
+
+    def feed():
+        try:
+            with open_zip_member(member_path) as member:
+                shutil.copyfileobj(member, proc.stdin, 1 << 20)
+        except (BrokenPipeError, OSError):
+            pass  # ffmpeg exited early; its stderr says why
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    return feeder
+
+def run_ffmpeg(cmd, member_path=None, stdout_sink=None):
+    """
+    Run an ffmpeg command and return (returncode, stderr). With member_path, ffmpeg
+    reads its input from stdin, fed straight from that zip member; with stdout_sink,
+    whatever ffmpeg writes to stdout is passed to it piece by piece.
+    Wall-clock and CPU time of the child process are recorded in the metrics.
+    """
+    import subprocess
+    import threading
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE if member_path else subprocess.DEVNULL,
+        stdout=subprocess.PIPE if stdout_sink else subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+    feeder = feed_zip_member(proc, member_path) if member_path else None
+    if stdout_sink:
+        # Drain stderr alongside stdout so neither pipe can fill up and stall ffmpeg
+        errors = []
+        reader = threading.Thread(target=lambda: errors.append(proc.stderr.read()), daemon=True)
+        reader.start()
+        for data in iter(lambda: proc.stdout.read(1 << 16), b''):
+            stdout_sink(data)
+        proc.stdout.close()
+        reader.join()
+        stderr = errors[0]
+    else:
+        stderr = proc.stderr.read()
+    proc.stderr.close()
+    cpu = None
+    if hasattr(os, 'wait4'):
+        # Reap the child ourselves to get its resource usage
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        cpu = usage.ru_utime + usage.ru_stime
+    else:
+        proc.wait()
+    if feeder:
+        feeder.join()
+    metrics.observe('slsync_ffmpeg_wall_seconds', time.perf_counter() - start)
+    if cpu is not None:
+        metrics.observe('slsync_ffmpeg_cpu_seconds', cpu)
+    return proc.returncode, stderr.decode(errors='replace')
+
+async def run_ffmpeg_async(cmd, member_path=None, stdout_sink=None):
+    """
+    run_ffmpeg as an asyncio subprocess: returns (returncode, stderr) without tying up
+    a thread while ffmpeg works. Zip member input is read in the default executor and
+    written to ffmpeg's stdin with flow control. Only wall-clock time is recorded,
+    since the event loop reaps the child itself.
+    """
+    import asyncio
+    import subprocess
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=subprocess.PIPE if member_path else subprocess.DEVNULL,
+        stdout=subprocess.PIPE if stdout_sink else subprocess.DEVNULL,
+        stderr=subprocess.PIPE
+    )
+
+    async def drain_stdout():
+        while True:
+            data = await proc.stdout.read(1 << 16)
+            if not data:
+                break
+            stdout_sink(data)
+
+    async def feed():
+        try:
+            member = await loop.run_in_executor(None, open_zip_member, member_path)
+            try:
+                while True:
+                    data = await loop.run_in_executor(None, member.read, 1 << 20)
+                    if not data:
+                        break
+                    proc.stdin.write(data)
+                    await proc.stdin.drain()
+            finally:
+                member.close()
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass  # ffmpeg exited early; its stderr says why
+        finally:
+            proc.stdin.close()
+
+    feeder = asyncio.ensure_future(feed()) if member_path else None
+    if stdout_sink:
+        stderr, _ = await asyncio.gather(proc.stderr.read(), drain_stdout())
+    else:
+        stderr = await proc.stderr.read()
+    await proc.wait()
+    if feeder:
+        await feeder
+    metrics.observe('slsync_ffmpeg_wall_seconds', time.perf_counter() - start)
+    return proc.returncode, stderr.decode(errors='replace')
+
+def _prepare_alac_conversion(src, cover=None, out_dir=None, remux=False, digest=False):
+    """
+    Work out the output path and ffmpeg command for converting src to ALAC
+    (or, with remux, for copying its ALAC stream into an .m4a as-is). With digest,
+    ffmpeg also writes the decoded PCM to stdout for a PcmDigester.
+    Returns (cmd, out_path, member_path to pipe to ffmpeg's stdin or None, spooled temp file or None).
+    """
+    zip_member = split_zip_member_path(src)
+    # Convert src to ALAC, same base name, .m4a extension: into out_dir if given, else next to the source
+    base = os.path.splitext(os.path.basename(src))[0]
+    if out_dir:
+        out_path = unique_output_path(out_dir, base, '.m4a')
+    else:
+        out_dir = os.path.dirname(zip_member[0] if zip_member else src)
+        out_path = unique_output_path(out_dir, base, '.m4a') if zip_member else os.path.join(out_dir, base + '.m4a')
+
+    input_path = src
+    spooled = None
+    if zip_member and os.path.splitext(src)[1].lower() in UNPIPEABLE_EXTENSIONS:
+        # MP4-family containers need a seekable input: spool just this member
+        import tempfile
+        fd, spooled = tempfile.mkstemp(prefix='slsync-', suffix=os.path.splitext(src)[1])
+        os.close(fd)
+        extract_zip_member(src, spooled)
+        input_path = spooled
+    piped = zip_member and spooled is None
+
+    # Build ffmpeg command: encode audio as ALAC, copy video streams if present (as in working shell command)
+    cmd = [
+        'ffmpeg',
+        '-y',
+        '-i', 'pipe:0' if piped else input_path,
+    ]
+    if cover:
+        # Attach the cover as a second input instead of rewriting the file afterwards
+        cmd += ['-i', cover, '-map', '0:a:0', '-map', '1:0', '-disposition:v:0', 'attached_pic']
+    cmd += [
+        '-c:a', 'copy' if remux else 'alac',
+        '-c:v', 'copy',
+        out_path
+    ]
+    if digest:
+        # Second output: the PCM compute_audio_hash() will see when it decodes out_path. The ALAC
+        # encoder takes 32-bit samples and keeps the top 24 bits, so go through s32 the same way.
+        cmd += [
+            '-map', '0:a:0',
+            '-af', 'aformat=sample_fmts=s32',
+            '-f', HASH_PCM_FORMAT,
+            '-acodec', f'pcm_{HASH_PCM_FORMAT}',
+            'pipe:1'
+        ]
+    return cmd, out_path, src if piped else None, spooled
+
+def _finish_alac_conversion(src, out_path, returncode, stderr):
+    """Check the ffmpeg result; returns out_path on success. The source is left for the caller to remove once the output is safe."""
+    if returncode != 0:
+        logger.error("ffmpeg error: %s", stderr)
         if os.path.exists(out_path):
             os.remove(out_path)
-        if os.path.exists(src):
-            os.remove(src)
+        return
+    if os.path.exists(out_path):
+        filename = os.path.basename(src)
+        alac_filename = os.path.basename(out_path)
+        logger.info("Converted to ALAC: %s -> %s", filename, alac_filename)
+        return out_path
+    else:
+        logger.error("Conversion failed: output file was not created for %s", os.path.basename(src))
         return
 
+def _abort_alac_conversion(src, out_path, error):
+    # Only the partial output goes: the source may be a download that is still being written
+    logger.error("Convert failed: %s -> ALAC | %s", os.path.basename(src), error)
+    if out_path and os.path.exists(out_path):
+        os.remove(out_path)
+
+def convert_to_alac(src, cover=None, out_dir=None, remux=False, digester=None):
+    """
+    Convert src to ALAC in out_dir, or next to the source (next to the archive for zip members).
+    With cover, the image is attached as the front cover in the same ffmpeg pass.
+    With remux, src must already be ALAC: its stream is copied into the .m4a without decoding.
+    With a PcmDigester, the output's audio hash is computed in the same ffmpeg run.
+    """
+    out_path = None
+    spooled = None
+    try:
+        logger.info("%s: %s", "Remuxing ALAC file to .m4a" if remux else "Converting audio file to ALAC format", src)
+        cmd, out_path, member_path, spooled = _prepare_alac_conversion(src, cover, out_dir, remux, digester is not None)
+        returncode, stderr = run_ffmpeg(cmd, member_path, digester.update if digester else None)
+        return _finish_alac_conversion(src, out_path, returncode, stderr)
+    except Exception as e:
+        _abort_alac_conversion(src, out_path, e)
+        return
+    finally:
+        if spooled and os.path.exists(spooled):
+            os.remove(spooled)
+
+async def convert_to_alac_async(src, cover=None, out_dir=None, remux=False, digester=None):
+    """convert_to_alac for the asyncio pipeline: ffmpeg runs as an asyncio subprocess, file work in the executor"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    out_path = None
+    spooled = None
+    try:
+        logger.info("%s: %s", "Remuxing ALAC file to .m4a" if remux else "Converting audio file to ALAC format", src)
+        cmd, out_path, member_path, spooled = await loop.run_in_executor(
+            None, _prepare_alac_conversion, src, cover, out_dir, remux, digester is not None)
+        returncode, stderr = await run_ffmpeg_async(cmd, member_path, digester.update if digester else None)
+        return await loop.run_in_executor(None, _finish_alac_conversion, src, out_path, returncode, stderr)
+    except Exception as e:
+        _abort_alac_conversion(src, out_path, e)
+        return
+    finally:
+        if spooled and os.path.exists(spooled):
+            os.remove(spooled)
+
 # def extract_zip(zip_path):
 #     """Extract zip file and return list of extracted files. Remove zip after extraction."""
 #     try:
@@ -116,111 +526,158 @@ def convert_to_alac(src):
 #     except Exception as e:
 #         print(f"[ERROR] Failed to extract {os.path.basename(zip_path)}: {e}")
 #         return []
-def extract_zip(zip_path):
-    """Extract zip file and return list of extracted files. Remove zip after extraction."""
-    # DEBUG: Print the exact path being passed
-    print(f"[DEBUG] extract_zip called with path: '{zip_path}'")
-    print(f"[DEBUG] File exists: {os.path.exists(zip_path)}")
-    
-    extracted_files = []
-    try:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(os.path.dirname(zip_path))
-            extracted_files = [os.path.join(os.path.dirname(zip_path), name) for name in zip_ref.namelist()]
-            print(f"[INFO] Extracted {len(extracted_files)} files from {os.path.basename(zip_path)}")
-        
-        # Remove the zip file AFTER successful extraction
-        try:
-            print(f"[DEBUG] Attempting to remove: '{zip_path}'")
-            os.remove(zip_path)
-            print(f"[INFO] Removed zip file: {os.path.basename(zip_path)}")
-        except Exception as e:
-            print(f"[WARNING] Could not remove zip file: {e}")
-            
-    except Exception as e:
-        print(f"[ERROR] Failed to extract {os.path.basename(zip_path)}: {e}")
-        
-    return extracted_files
 
-def extract_metadata(filepath, fields): ## Returns a dict of requested metadata fields.
+def extract_metadata(filepath, fields, info=None): ## Returns a dict of requested metadata fields.
     """
-    Extract specified metadata fields from an audio file using mutagen.
-    Returns a dict of field: value.
+    Extract specified metadata fields from an audio file.
+    Returns a dict of field: value. Pass an existing MediaProbe as `info` to avoid reopening the file.
     """
-    from mutagen import File
-    audio = File(filepath, easy=True)
-    if audio is None:
-        raise ValueError(f"Unsupported or unreadable file: {filepath}")
-    # Print all raw tags for debugging
+    info = info or probe(filepath)
     # Always extract discnumber and tracknumber for path construction
     always_fields = ['discnumber', 'DISCNUMBER', 'disc', 'discc', 'tracknumber', 'TRACKNUMBER', 'track']
     all_fields = list(set(fields) | set(always_fields))
-    result = {}
-    for field in all_fields:
-        value = audio.get(field)
-        if isinstance(value, list):
-            value = value[0] if value else None
-        result[field] = value
-    return result
+    return {field: info.tag(field) for field in all_fields}
 
-def extract_audio_properties(filepath, fields):
+def extract_audio_properties(filepath, fields, info=None):
     """
     Extract specified audio properties (e.g., duration, bitrate, sample rate, channels, codec).
-    Returns a dict of property: value. Uses ffprobe for bitrate if mutagen fails.
+    Returns a dict of property: value. Pass an existing MediaProbe as `info` to avoid reopening the file.
+    """
+    info = info or probe(filepath)
+    return {field: info.audio_property(field) for field in fields}
+
+HASH_CHUNK_SIZE = 1 << 20  # bytes of decoded PCM per chunk digest
+# Audio is hashed as 24-bit PCM: every sample of a 16- or 24-bit master exactly, and the
+# most ALAC stores, so a converted copy hashes the same as the (lossless) download
+HASH_PCM_FORMAT = 's24le'
+# Bumped whenever the hashed PCM changes, so digests stored by older versions are dropped
+AUDIO_HASH_VERSION = 2
+PCM_DIGESTS_KIND = f'pcm_digests_v{AUDIO_HASH_VERSION}'
+
+
+def iter_pcm_chunks(filepath, chunk_size=HASH_CHUNK_SIZE, sample_rate=None, channels=None, max_seconds=None,
+                    pcm_format='s16le'):
+    """
+    Decode the first audio stream of a file with ffmpeg and yield the raw PCM
+    (signed 16-bit little-endian, or pcm_format) in fixed-size chunks. Only one chunk is held in
+    memory at a time; closing the generator early stops the decoder.
+    sample_rate, channels and max_seconds resample, downmix and truncate the stream;
+    by default it is decoded as-is. Zip members are streamed to ffmpeg's stdin.
     """
-    from mutagen import File
     import subprocess
-    import json
-    audio = File(filepath)
-    if audio is None:
-        raise ValueError(f"Unsupported or unreadable file: {filepath}")
-    info = getattr(audio, 'info', None)
-    if info is None:
-        raise ValueError(f"No audio info found for file: {filepath}")
-    result = {}
-    for field in fields:
-        key = field.upper()
-        if key == "DURATION":
-            result[field] = getattr(info, 'length', None)
-        elif key == "BITRATE":
-            # Use ffprobe for bitrate extraction
-            try:
-                cmd = [
-                    'ffprobe',
-                    '-v', 'error',
-                    '-select_streams', 'a:0',
-                    '-show_entries', 'stream=bit_rate',
-                    '-of', 'json',
-                    filepath
-                ]
-                output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-                data = json.loads(output.decode("utf-8"))
-                streams = data.get('streams', [])
-                if streams and 'bit_rate' in streams[0]:
-                    bitrate = int(streams[0]['bit_rate'])
-                else:
-                    bitrate = None
-            except Exception:
-                bitrate = None
-            result[field] = bitrate
-        elif key == "SAMPLE_RATE":
-            result[field] = getattr(info, 'sample_rate', None)
-        elif key == "CHANNELS":
-            result[field] = getattr(info, 'channels', None)
-        elif key == "CODEC":
-            result[field] = type(info).__name__
-        else:
-            result[field] = None
-    return result
+    piped = split_zip_member_path(filepath) is not None
+    cmd = [
+        'ffmpeg',
+        '-v', 'error',
+        '-i', 'pipe:0' if piped else filepath,
+        '-map', '0:a:0',
+    ]
+    if max_seconds:
+        cmd += ['-t', str(max_seconds)]
+    if sample_rate:
+        cmd += ['-ar', str(sample_rate)]
+    if channels:
+        cmd += ['-ac', str(channels)]
+    cmd += [
+        '-f', pcm_format,
+        '-acodec', f'pcm_{pcm_format}',
+        '-'
+    ]
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE if piped else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    feeder = feed_zip_member(proc, filepath) if piped else None
+    finished = False
+    try:
+        buf = bytearray()
+        while True:
+            data = proc.stdout.read(chunk_size - len(buf))
+            if not data:
+                break
+            buf += data
+            if len(buf) == chunk_size:
+                yield bytes(buf)
+                buf.clear()
+        if buf:
+            yield bytes(buf)
+        finished = True
+    finally:
+        if not finished:
+            proc.kill()
+        proc.stdout.close()
+        stderr = proc.stderr.read()
+        proc.stderr.close()
+        proc.wait()
+        if feeder:
+            feeder.join()
+    if proc.returncode != 0:
+        raise ValueError(f"ffmpeg could not decode {os.path.basename(filepath)}: {stderr.decode(errors='replace').strip()}")
+
+
+class PcmDigester:
+    """
+    Incremental hash_audio_stream(): fed decoded PCM in pieces of any size, e.g. the
+    second output of a conversion, it produces the same digests.
+    """
+
+    def __init__(self, chunk_size=HASH_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.full = hashlib.sha256()
+        self.buf = bytearray()
+        self.chunk_digests = []
+
+    def update(self, data):
+        self.full.update(data)
+        self.buf += data
+        while len(self.buf) >= self.chunk_size:
+            self.chunk_digests.append(hashlib.blake2b(self.buf[:self.chunk_size], digest_size=16).hexdigest())
+            del self.buf[:self.chunk_size]
+
+    def result(self):
+        """(sha256 hex digest of the whole stream, list of per-chunk digests)"""
+        if self.buf:
+            self.chunk_digests.append(hashlib.blake2b(self.buf, digest_size=16).hexdigest())
+            self.buf.clear()
+        return self.full.hexdigest(), self.chunk_digests
+
+
+def hash_audio_stream(filepath, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Stream-hash the decoded audio of a file.
+    Returns (sha256 hex digest of the whole stream, list of per-chunk digests).
+    """
+    digester = PcmDigester(chunk_size)
+    for chunk in iter_pcm_chunks(filepath, chunk_size, pcm_format=HASH_PCM_FORMAT):
+        digester.update(chunk)
+    return digester.result()
+
 
 def compute_audio_hash(filepath):
     """
-    Compute a hash of the audio content (raw PCM data) using pydub and hashlib.
+    Compute a hash of the audio content (raw PCM data) by streaming it from ffmpeg.
+    Memory use is bounded by HASH_CHUNK_SIZE regardless of track length.
     Returns a hex digest string.
     """
-    import hashlib
-    from pydub import AudioSegment
-    audio = AudioSegment.from_file(filepath)
-    raw_data = audio.raw_data
-    return hashlib.sha256(raw_data).hexdigest()
+    return hash_audio_stream(filepath)[0]
+
 
+def audio_matches_digests(filepath, chunk_digests, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Compare the decoded audio of a file against previously recorded chunk digests,
+    stopping the decoder at the first chunk that differs.
+    """
+    chunks = iter_pcm_chunks(filepath, chunk_size, pcm_format=HASH_PCM_FORMAT)
+    count = 0
+    try:
+        for chunk in chunks:
+            if count >= len(chunk_digests):
+                return False
+            if hashlib.blake2b(chunk, digest_size=16).hexdigest() != chunk_digests[count]:
+                return False
+            count += 1
+    finally:
+        chunks.close()
+    return count == len(chunk_digests)
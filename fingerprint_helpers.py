@@ -0,0 +1,263 @@
+import os
+import base64
+import logging
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; AUDIO_FINGERPRINT is unavailable without it
+    np = None
+
+from file_helpers import iter_pcm_chunks
+
+logger = logging.getLogger(__name__)
+
+# Fingerprints are computed from the first couple of minutes of a downsampled mono stream
+FINGERPRINT_SAMPLE_RATE = 11025
+FINGERPRINT_SECONDS = 120
+FRAME_SIZE = 4096            # samples per chroma frame (~0.37 s)
+MIN_FREQUENCY = 55.0
+MAX_FREQUENCY = 5000.0
+MIN_FRAMES = 8
+# Frames two fingerprints may be shifted by (leading silence, encoder delay)
+MAX_OFFSET_FRAMES = 8
+DEFAULT_THRESHOLD = 0.8
+# LSH: the fingerprint is pooled into a fixed-size descriptor and hashed with random hyperplanes
+DESCRIPTOR_SEGMENTS = 16
+LSH_BANDS = 10
+LSH_BAND_BITS = 12
+LSH_SEED = 20240601
+
+_chroma_basis = None
+_planes = None
+
+
+def fingerprint_available():
+    return np is not None
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("numpy is required for audio fingerprints (pip install numpy)")
+
+
+def _get_chroma_basis():
+    """Matrix folding the FFT bins of a frame onto the 12 pitch classes"""
+    global _chroma_basis
+    if _chroma_basis is None:
+        freqs = np.fft.rfftfreq(FRAME_SIZE, 1.0 / FINGERPRINT_SAMPLE_RATE)
+        basis = np.zeros((len(freqs), 12), dtype=np.float32)
+        usable = (freqs >= MIN_FREQUENCY) & (freqs <= MAX_FREQUENCY)
+        pitch_class = np.round(12 * np.log2(freqs[usable] / 440.0)).astype(int) % 12
+        basis[np.nonzero(usable)[0], pitch_class] = 1.0
+        _chroma_basis = basis
+    return _chroma_basis
+
+
+def _get_planes():
+    global _planes
+    if _planes is None:
+        rng = np.random.default_rng(LSH_SEED)
+        _planes = rng.standard_normal((LSH_BANDS * LSH_BAND_BITS, DESCRIPTOR_SEGMENTS * 12)).astype(np.float32)
+    return _planes
+
+
+def compute_fingerprint(filepath):
+    """
+    Chroma fingerprint of a file's audio: one 12-bin pitch-class profile per frame,
+    log-compressed and scaled per frame, as a (frames, 12) uint8 array. Pitch content
+    survives re-encoding, lossy codecs and small timing shifts, unlike the raw PCM.
+    """
+    _require_numpy()
+    pcm = b''.join(iter_pcm_chunks(filepath, sample_rate=FINGERPRINT_SAMPLE_RATE, channels=1,
+                                   max_seconds=FINGERPRINT_SECONDS))
+    samples = np.frombuffer(pcm, dtype='<i2').astype(np.float32) / 32768.0
+    frames = len(samples) // FRAME_SIZE
+    if frames < MIN_FRAMES:
+        raise ValueError(f"{os.path.basename(filepath)} is too short to fingerprint")
+    window = np.hanning(FRAME_SIZE).astype(np.float32)
+    spectrum = np.abs(np.fft.rfft(samples[:frames * FRAME_SIZE].reshape(frames, FRAME_SIZE) * window, axis=1)) ** 2
+    chroma = np.log1p(spectrum @ _get_chroma_basis())
+    peak = chroma.max(axis=1, keepdims=True)
+    chroma /= np.where(peak > 0, peak, 1.0)
+    return np.round(chroma * 255).astype(np.uint8)
+
+
+def encode_fingerprint(fingerprint):
+    """JSON-friendly form of a fingerprint, for the probe cache"""
+    return base64.b64encode(fingerprint.tobytes()).decode('ascii')
+
+
+def decode_fingerprint(value):
+    _require_numpy()
+    return np.frombuffer(base64.b64decode(value), dtype=np.uint8).reshape(-1, 12)
+
+
+def cached_fingerprint(filepath, cache=None):
+    """Fingerprint of a file, read through the probe cache when one is given"""
+    if cache is None:
+        return compute_fingerprint(filepath)
+    value = cache.get_or_compute(filepath, 'fingerprint', lambda p: encode_fingerprint(compute_fingerprint(p)))
+    return decode_fingerprint(value)
+
+
+def fingerprint_similarity(a, b, max_offset=MAX_OFFSET_FRAMES):
+    """
+    Best correlation (-1..1) of two fingerprints over shifts of up to max_offset frames.
+    Each pitch class is centred over time, so what is compared is how the harmony
+    moves, not just the key both tracks happen to be in.
+    """
+    _require_numpy()
+    best = -1.0
+    for offset in range(-max_offset, max_offset + 1):
+        x = a[offset:] if offset > 0 else a
+        y = b[-offset:] if offset < 0 else b
+        n = min(len(x), len(y))
+        if n < MIN_FRAMES:
+            continue
+        x = x[:n].astype(np.float32)
+        y = y[:n].astype(np.float32)
+        x -= x.mean(axis=0)
+        y -= y.mean(axis=0)
+        denom = np.sqrt(np.sum(x * x) * np.sum(y * y))
+        if denom > 0:
+            best = max(best, float(np.sum(x * y) / denom))
+    return best
+
+
+def fingerprint_signature(fingerprint):
+    """LSH band keys of a fingerprint: similar fingerprints share at least one band with high probability"""
+    segments = np.array_split(fingerprint.astype(np.float32), min(DESCRIPTOR_SEGMENTS, len(fingerprint)))
+    descriptor = np.zeros((DESCRIPTOR_SEGMENTS, 12), dtype=np.float32)
+    descriptor[:len(segments)] = [segment.mean(axis=0) for segment in segments]
+    descriptor = descriptor.ravel() - descriptor.mean()
+    bits = (_get_planes() @ descriptor) > 0
+    weights = 1 << np.arange(LSH_BAND_BITS)
+    return tuple(int(band @ weights) for band in bits.reshape(LSH_BANDS, LSH_BAND_BITS))
+
+
+class FingerprintIndex:
+    """
+    Locality-sensitive hash index of library fingerprints.
+    Only LSH band keys are held in memory; fingerprints live in the probe cache and are
+    loaded for the few candidates a query turns up, so a new download is compared
+    against a handful of tracks instead of the whole library. Fingerprinting the
+    library is slow, so sync() runs in a background thread and the index fills in
+    as it goes.
+    """
+
+    def __init__(self, cache=None, threshold=DEFAULT_THRESHOLD):
+        _require_numpy()
+        self.cache = cache
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.stamps = {}       # path -> (size, mtime_ns) the signature was computed for
+        self.signatures = {}   # path -> band keys
+        self.bands = [{} for _ in range(LSH_BANDS)]  # per band: key -> set of paths
+        self.failed = {}       # path -> stamp of a version that could not be fingerprinted
+        self.sync_requested = False
+        self.sync_thread = None
+        self.stopped = False
+
+    def _link(self, path, stamp, signature):
+        self.stamps[path] = stamp
+        self.signatures[path] = signature
+        for table, key in zip(self.bands, signature):
+            table.setdefault(key, set()).add(path)
+
+    def _unlink(self, path):
+        self.stamps.pop(path, None)
+        signature = self.signatures.pop(path, None)
+        if signature is None:
+            return
+        for table, key in zip(self.bands, signature):
+            paths = table.get(key)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del table[key]
+
+    def add(self, path, stamp):
+        """Fingerprint a library file (through the cache) and index it"""
+        try:
+            signature = fingerprint_signature(cached_fingerprint(path, self.cache))
+        except Exception as e:
+            logger.debug("Could not fingerprint %s: %s", os.path.basename(path), e)
+            with self.lock:
+                self.failed[path] = stamp
+            return False
+        with self.lock:
+            self.failed.pop(path, None)
+            self._unlink(path)
+            self._link(path, stamp, signature)
+        return True
+
+    def remove(self, path):
+        with self.lock:
+            self._unlink(path)
+
+    def sync(self, stamps):
+        """Bring the index in line with {path: (size, mtime_ns)} of the library"""
+        with self.lock:
+            stale = [p for p, stamp in self.stamps.items() if stamps.get(p) != stamp]
+            for path in stale:
+                self._unlink(path)
+            missing = [(p, stamp) for p, stamp in stamps.items()
+                       if p not in self.stamps and self.failed.get(p) != stamp]
+        if not missing:
+            return
+        logger.info("Fingerprinting %s library track(s)...", len(missing))
+        added = 0
+        for path, stamp in missing:
+            if self.stopped:
+                return
+            if self.add(path, stamp):
+                added += 1
+        logger.info("Fingerprint index ready: %s track(s), %s of %s new fingerprinted", len(self), added, len(missing))
+
+    def sync_in_background(self, stamps_fn):
+        """Run sync(stamps_fn()) on a background thread; requests made while one runs are folded into a rerun"""
+        with self.lock:
+            self.sync_requested = True
+            if self.sync_thread is not None:
+                return
+            self.sync_thread = threading.Thread(
+                target=self._sync_loop, args=(stamps_fn,), name='fingerprint-sync', daemon=True)
+            self.sync_thread.start()
+
+    def _sync_loop(self, stamps_fn):
+        while not self.stopped:
+            with self.lock:
+                if not self.sync_requested:
+                    self.sync_thread = None
+                    return
+                self.sync_requested = False
+            try:
+                self.sync(stamps_fn())
+            except Exception as e:
+                logger.error("Fingerprint index sync failed: %s", e)
+
+    def query(self, fingerprint):
+        """Library paths whose fingerprint is at least `threshold` similar, best match first"""
+        signature = fingerprint_signature(fingerprint)
+        with self.lock:
+            candidates = set()
+            for table, key in zip(self.bands, signature):
+                candidates.update(table.get(key, ()))
+        matches = []
+        for path in candidates:
+            try:
+                score = fingerprint_similarity(fingerprint, cached_fingerprint(path, self.cache))
+            except Exception as e:
+                logger.debug("Could not compare against %s: %s", os.path.basename(path), e)
+                continue
+            if score >= self.threshold:
+                matches.append((score, path))
+        return [path for _, path in sorted(matches, reverse=True)]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.signatures)
+
+    def close(self):
+        self.stopped = True
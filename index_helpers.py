@@ -0,0 +1,320 @@
+import os
+import logging
+import re
+import sqlite3
+import threading
+
+from watchdog.events import FileSystemEventHandler
+
+from probe_helpers import probe
+from file_helpers import PCM_DIGESTS_KIND, AUDIO_HASH_VERSION
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKET_SECONDS = 2
+
+
+def normalize_tag(value):
+    """Casefold and collapse whitespace so cosmetic tag differences don't matter"""
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = value[0] if value else ''
+    return re.sub(r'\s+', ' ', str(value)).strip().casefold()
+
+
+def normalize_number(value):
+    """Turn '3', '03' or '3/12' into 3; anything unparsable becomes 0"""
+    value = normalize_tag(value).split('/')[0]
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def make_track_key(artist, album, disc, track, title):
+    return '\x1f'.join([
+        normalize_tag(artist),
+        normalize_tag(album),
+        str(normalize_number(disc)),
+        str(normalize_number(track)),
+        normalize_tag(title),
+    ])
+
+
+def _album_key(track_key):
+    """The (artist, album) part of a track key"""
+    return tuple(track_key.split('\x1f', 2)[:2])
+
+
+def duration_bucket(length):
+    if length is None:
+        return None
+    return int(length // DURATION_BUCKET_SECONDS)
+
+
+def read_index_facts(filepath, cache=None):
+    """Read the tag key and duration bucket for a file, or None if it has no usable tags"""
+    info = probe(filepath, cache)
+    if not normalize_tag(info.tag('title')):
+        return None
+    key = make_track_key(
+        info.tag('artist'), info.tag('album'),
+        info.tag('discnumber'), info.tag('tracknumber'), info.tag('title')
+    )
+    return key, duration_bucket(info.duration)
+
+
+def iter_library(folder, supported_extensions):
+    """Walk a folder with os.scandir, yielding (path, stat) for supported audio files"""
+    stack = [folder]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in supported_extensions:
+                        yield entry.path, entry.stat()
+        except OSError as e:
+            logger.warning("Could not scan library folder %s: %s", current, e)
+
+
+class LibraryIndex:
+    """
+    In-memory index of the music library, persisted to SQLite so restarts only
+    re-read files whose size or mtime changed. Files are looked up by normalized
+    (artist, album, disc, track, title), narrowed by duration bucket, or by audio hash.
+    find_album() hands out all of one album's entries at once, so a batch of tracks
+    from the same album can be matched without a lookup per track.
+    """
+
+    def __init__(self, library_folder, db_path, supported_extensions, cache=None):
+        self.library_folder = os.path.normpath(library_folder)
+        self.supported_extensions = supported_extensions
+        self.cache = cache
+        self.lock = threading.RLock()
+        self.entries = {}   # path -> (size, mtime_ns, key, bucket, audio_hash)
+        self.by_key = {}    # key -> set of paths
+        self.by_hash = {}   # audio_hash -> set of paths
+        self.by_album = {}  # (artist, album) -> set of paths
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS library_index ('
+            ' path TEXT PRIMARY KEY,'
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' track_key TEXT NOT NULL,'
+            ' duration_bucket INTEGER,'
+            ' audio_hash TEXT)'
+        )
+        self.conn.execute('CREATE TABLE IF NOT EXISTS library_index_state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        row = self.conn.execute("SELECT value FROM library_index_state WHERE key = 'audio_hash_version'").fetchone()
+        if row is None or row[0] != AUDIO_HASH_VERSION:
+            # Hashes of an older PCM format never match new ones
+            self.conn.execute('UPDATE library_index SET audio_hash = NULL')
+            self.conn.execute("INSERT OR REPLACE INTO library_index_state VALUES ('audio_hash_version', ?)",
+                              (AUDIO_HASH_VERSION,))
+        self.conn.commit()
+
+    def _link(self, path, entry):
+        self.entries[path] = entry
+        self.by_key.setdefault(entry[2], set()).add(path)
+        self.by_album.setdefault(_album_key(entry[2]), set()).add(path)
+        if entry[4]:
+            self.by_hash.setdefault(entry[4], set()).add(path)
+
+    def _unlink(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is None:
+            return
+        for table, value in ((self.by_key, entry[2]), (self.by_album, _album_key(entry[2])), (self.by_hash, entry[4])):
+            paths = table.get(value)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del table[value]
+
+    def _iter_library(self, folder):
+        return iter_library(folder, self.supported_extensions)
+
+    def build(self):
+        """Load the persisted index and reconcile it with one walk of the library folder"""
+        with self.lock:
+            for path, size, mtime_ns, key, bucket, audio_hash in self.conn.execute(
+                    'SELECT path, size, mtime_ns, track_key, duration_bucket, audio_hash FROM library_index'):
+                self._link(path, (size, mtime_ns, key, bucket, audio_hash))
+        seen = set()
+        updated = 0
+        for path, st in self._iter_library(self.library_folder):
+            seen.add(path)
+            if self._update(path, st):
+                updated += 1
+        with self.lock:
+            stale = [p for p in self.entries if p not in seen]
+            for path in stale:
+                self._remove(path, commit=False)
+            self.conn.commit()
+        logger.info("Library index ready: %s track(s), %s re-read, %s removed", len(self.entries), updated, len(stale))
+
+    def _update(self, path, st):
+        """
+        (Re)index one file if its size or mtime changed. Returns True if it was re-read.
+        The row is committed straight away: an open write transaction here would lock the
+        probe cache, which shares the database, out of writing the next file's probe.
+        """
+        with self.lock:
+            current = self.entries.get(path)
+            if current and current[0] == st.st_size and current[1] == st.st_mtime_ns:
+                return False
+        try:
+            facts = read_index_facts(path, self.cache)
+        except Exception as e:
+            logger.warning("Could not index %s: %s", os.path.basename(path), e)
+            facts = None
+        audio_hash = None
+        if self.cache is not None:
+            # Tracks slsync imported had their audio hash computed during conversion
+            digests = self.cache.claim(path, PCM_DIGESTS_KIND)
+            if digests is None:
+                digests = self.cache.get(path, PCM_DIGESTS_KIND)[1]
+            audio_hash = digests[0] if digests else None
+        with self.lock:
+            self._unlink(path)
+            if facts is None:
+                self.conn.execute('DELETE FROM library_index WHERE path = ?', (path,))
+            else:
+                entry = (st.st_size, st.st_mtime_ns, facts[0], facts[1], audio_hash)
+                self._link(path, entry)
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO library_index VALUES (?, ?, ?, ?, ?, ?)', (path,) + entry)
+            self.conn.commit()
+        return True
+
+    def _remove(self, path, commit=True):
+        with self.lock:
+            self._unlink(path)
+            self.conn.execute('DELETE FROM library_index WHERE path = ?', (path,))
+            if commit:
+                self.conn.commit()
+
+    def refresh(self, paths):
+        """Bring the index up to date for a batch of changed paths (files or folders)"""
+        for path in paths:
+            if os.path.isdir(path):
+                seen = set()
+                for child, st in self._iter_library(path):
+                    seen.add(child)
+                    self._update(child, st)
+                prefix = path.rstrip(os.sep) + os.sep
+                with self.lock:
+                    gone = [p for p in self.entries if p.startswith(prefix) and p not in seen]
+                for p in gone:
+                    self._remove(p, commit=False)
+            elif os.path.isfile(path):
+                if os.path.splitext(path)[1].lower() in self.supported_extensions:
+                    self._update(path, os.stat(path))
+            else:
+                prefix = path.rstrip(os.sep) + os.sep
+                with self.lock:
+                    gone = [p for p in self.entries if p == path or p.startswith(prefix)]
+                for p in gone:
+                    self._remove(p, commit=False)
+        with self.lock:
+            self.conn.commit()
+
+    def set_hash(self, path, audio_hash):
+        """Record the audio hash of an indexed library file"""
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[4] == audio_hash:
+                return
+            self._unlink(path)
+            self._link(path, entry[:4] + (audio_hash,))
+            self.conn.execute('UPDATE library_index SET audio_hash = ? WHERE path = ?', (audio_hash, path))
+            self.conn.commit()
+
+    def find_by_tags(self, artist, album, disc, track, title, length=None):
+        """Return library paths with the same normalized tags (and a neighbouring duration bucket, if known)"""
+        if not normalize_tag(title):
+            return []
+        key = make_track_key(artist, album, disc, track, title)
+        with self.lock:
+            entries = [(p, self.entries[p][3]) for p in self.by_key.get(key, ())]
+        return _within_bucket(entries, duration_bucket(length))
+
+    def find_album(self, artist, album):
+        """Snapshot of one album's library entries as {track key: [(path, duration bucket)]}, for match_album()"""
+        result = {}
+        with self.lock:
+            for path in self.by_album.get((normalize_tag(artist), normalize_tag(album)), ()):
+                entry = self.entries[path]
+                result.setdefault(entry[2], []).append((path, entry[3]))
+        return result
+
+    def find_candidates(self, filepath, info=None):
+        """Return library paths that may hold the same track as a new file"""
+        info = info or probe(filepath)
+        return self.find_by_tags(
+            info.tag('artist'), info.tag('album'),
+            info.tag('discnumber'), info.tag('tracknumber'), info.tag('title'), info.duration
+        )
+
+    def find_by_hash(self, audio_hash):
+        with self.lock:
+            return list(self.by_hash.get(audio_hash, ()))
+
+    def has_hashes(self):
+        with self.lock:
+            return bool(self.by_hash)
+
+    def stamps(self):
+        """{path: (size, mtime_ns)} of every indexed file"""
+        with self.lock:
+            return {path: entry[:2] for path, entry in self.entries.items()}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def _within_bucket(entries, bucket):
+    return [p for p, b in entries if bucket is None or b is None or abs(b - bucket) <= 1]
+
+
+def match_album(album_entries, info):
+    """find_candidates() against a find_album() snapshot: library paths that may hold the same track"""
+    if not normalize_tag(info.tag('title')):
+        return []
+    key = make_track_key(
+        info.tag('artist'), info.tag('album'),
+        info.tag('discnumber'), info.tag('tracknumber'), info.tag('title')
+    )
+    return _within_bucket(album_entries.get(key, ()), duration_bucket(info.duration))
+
+
+class LibraryIndexHandler(FileSystemEventHandler):
+    """Feed library folder changes into a coalescer that refreshes the index in batches"""
+
+    def __init__(self, coalescer):
+        self.coalescer = coalescer
+
+    def on_created(self, event):
+        self.coalescer.add(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.coalescer.add(event.src_path)
+
+    def on_deleted(self, event):
+        self.coalescer.add(event.src_path)
+
+    def on_moved(self, event):
+        self.coalescer.add(event.src_path)
+        self.coalescer.add(event.dest_path)
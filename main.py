@@ -2,8 +2,11 @@
 
 
 import os
+import sys
 import time
-import shutil
+import asyncio
+import argparse
+import logging
 import yaml
 
 
@@ -11,107 +14,820 @@ from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 # Import duplicate checking logic
-from duplication_helpers import  is_duplicate, construct_audio_dest
+from duplication_helpers import  is_duplicate, construct_audio_dest, fingerprint_criteria
+
+# Import acoustic fingerprints and their LSH index
+from fingerprint_helpers import FingerprintIndex, cached_fingerprint, fingerprint_available
 
 # Import file manipulation logic
-from file_helpers import is_alac, convert_to_alac, find_audio_files
+from file_helpers import conversion_route, ROUTE_MOVE, ROUTE_REMUX, convert_to_alac_async, find_audio_files, path_stamp, source_path
+from file_helpers import staging_dir_for, recover_staging_slots, new_staging_slot, release_staging_slot, mark_slot_done
+from file_helpers import move_to_dest, remove_source, PcmDigester, hash_audio_stream, PCM_DIGESTS_KIND
+
+# Import single-pass media probe
+from probe_helpers import probe_many
+
+# Import zip member handling
+from zip_helpers import split_zip_member_path, ZipTracker
+
+# Import the staged asyncio ingest pipeline
+from pipeline_helpers import IngestPipeline, Stage, group_consecutive
+
+# Import persistent probe/hash cache and ingest journal
+from cache_helpers import ProbeCache, IngestJournal
+
+# Import filesystem event batching
+from event_helpers import EventCoalescer, StabilityTracker
+
+# Import the library-wide duplicate scan
+from dedupe_helpers import DedupeScan, MODE_HASH, MODE_FINGERPRINT, write_report
+
+# Import library index for duplicate lookup
+from index_helpers import LibraryIndex, LibraryIndexHandler, match_album, normalize_tag
+
+# Import album art lookup
+from album_art_helper import ArtResolver, ArtPending, CoverCache, find_local_art, art_directory, find_album_art, embed_art_in_place
+
+# Import download event tracing
+from trace_helpers import TraceRecorder
+
+# Import logging setup and metrics
+from metrics_helpers import metrics, setup_logging, start_metrics_server, StatsFileWriter
+
+logger = logging.getLogger('slsync')
 
 # Load config from config.yaml
 script_dir = os.path.dirname(os.path.realpath(__file__))
-config_path = os.path.join(script_dir, 'config.yaml')
+config_path = os.environ.get('SLSYNC_CONFIG') or os.path.join(script_dir, 'config.yaml')
 with open(config_path, 'r') as f:
     config = yaml.safe_load(f)
 
+setup_logging((config.get('LOGGING', {}) or {}).get('LEVEL', 'INFO'))
+
 DOWNLOAD_FOLDERS = config['DOWNLOAD_FOLDERS']
 DEST_FOLDER = config['DEST_FOLDER']
 LIBRARY_FOLDER = config.get('LIBRARY_FOLDER', None)
+STAGING_FOLDER = config.get('STAGING_FOLDER') or None
+staging_dir = None
 SUPPORTED_EXTENSIONS = set(config['SUPPORTED_EXTENSIONS'])
 should_skip_duplicates = config.get('SKIP_DUPLICATES', {}).get('ENABLED', 'NO')
-print(f"[DEBUG] SKIP_DUPLICATES.ENABLED value: {should_skip_duplicates}")
+logger.debug("SKIP_DUPLICATES.ENABLED value: %s", should_skip_duplicates)
 dup_criteria = config.get('SKIP_DUPLICATES', {}).get('CRITERIA', {})
+USE_FINGERPRINT, FINGERPRINT_THRESHOLD = fingerprint_criteria(dup_criteria)
+USE_AUDIO_HASH = bool(should_skip_duplicates) and dup_criteria.get('AUDIO_HASH', False) is True
+if USE_FINGERPRINT and not fingerprint_available():
+    logger.warning("AUDIO_FINGERPRINT needs numpy (pip install numpy); using the other duplicate criteria")
+    USE_FINGERPRINT = False
+    dup_criteria = dict(dup_criteria, AUDIO_FINGERPRINT=False)
+fingerprint_index = None
+conversion_config = config.get('CONVERSION', {}) or {}
+CONVERSION_WORKERS = int(conversion_config.get('WORKERS', 0) or 0)
+CONVERSION_QUEUE_SIZE = int(conversion_config.get('QUEUE_SIZE', 64) or 64)
+pipeline_config = config.get('PIPELINE', {}) or {}
+DISCOVER_WORKERS = int(pipeline_config.get('DISCOVER_WORKERS', 1) or 1)
+PROBE_WORKERS = int(pipeline_config.get('PROBE_WORKERS', 4) or 4)
+DEDUP_WORKERS = int(pipeline_config.get('DEDUP_WORKERS', 2) or 2)
+ROUTE_WORKERS = int(pipeline_config.get('ROUTE_WORKERS', 2) or 2)
+MOVE_WORKERS = int(pipeline_config.get('MOVE_WORKERS', 2) or 2)
+ALBUM_MAX_TRACKS = int(pipeline_config.get('ALBUM_MAX_TRACKS', 100) or 100)
+pipeline = None
+conversion_slots = None
+cache_config = config.get('CACHE', {}) or {}
+CACHE_PATH = os.path.join(script_dir, cache_config.get('PATH', 'slsync_cache.db'))
+CACHE_MAX_ENTRIES = int(cache_config.get('MAX_ENTRIES', 100000))
+probe_cache = None
+ingest_journal = None
+index_config = config.get('LIBRARY_INDEX', {}) or {}
+LIBRARY_INDEX_ENABLED = index_config.get('ENABLED', True)
+LIBRARY_INDEX_WATCH = index_config.get('WATCH', True)
+library_index = None
+events_config = config.get('EVENTS', {}) or {}
+EVENT_SETTLE_SECONDS = float(events_config.get('SETTLE_SECONDS', 1.0))
+EVENT_MAX_WAIT_SECONDS = float(events_config.get('MAX_WAIT_SECONDS', 10.0))
+stability_config = config.get('STABILITY', {}) or {}
+STABILITY_QUIET_SECONDS = float(stability_config.get('QUIET_SECONDS', 5.0))
+STABILITY_CHECK_INTERVAL = float(stability_config.get('CHECK_INTERVAL', 1.0))
+STABILITY_MAX_WAIT_SECONDS = float(stability_config.get('MAX_WAIT_SECONDS', 21600))
+STABILITY_OPEN_FILE_CHECK = stability_config.get('OPEN_FILE_CHECK', True)
+zip_tracker = ZipTracker()
+metrics_config = config.get('METRICS', {}) or {}
+METRICS_PORT = int(metrics_config.get('PORT', 0) or 0)
+METRICS_STATS_FILE = metrics_config.get('STATS_FILE') or None
+METRICS_INTERVAL = float(metrics_config.get('INTERVAL', 10))
+trace_config = config.get('TRACE', {}) or {}
+TRACE_FILE = trace_config.get('FILE') or None
+art_config = config.get('ALBUM_ART', {}) or {}
+ALBUM_ART_ENABLED = art_config.get('ENABLED', False)
+ALBUM_ART_ONLINE_LOOKUP = art_config.get('ONLINE_LOOKUP', False)
+ALBUM_ART_MAX_SIZE = int(art_config.get('COVER_MAX_SIZE', 1000))
+ALBUM_ART_CACHE_DIR = os.path.join(script_dir, art_config.get('CACHE_DIR', 'slsync_art'))
+ALBUM_ART_MISS_TTL = float(art_config.get('MISS_TTL_DAYS', 7)) * 86400
+ALBUM_ART_WORKERS = int(art_config.get('WORKERS', 2) or 2)
+ALBUM_ART_RATE = float(art_config.get('RATE_LIMIT', 1.0))
+ALBUM_ART_TIMEOUT = float(art_config.get('TIMEOUT', 10))
+ALBUM_ART_CONVERT_WAIT = float(art_config.get('CONVERT_WAIT', 0.5))
+ALBUM_ART_MUSICBRAINZ_URL = art_config.get('MUSICBRAINZ_URL', 'https://musicbrainz.org')
+ALBUM_ART_COVERART_URL = art_config.get('COVERART_URL', 'https://coverartarchive.org')
+art_resolver = None
+cover_cache = None
+
+def album_cover(filepath, info, wait=None):
+    """
+    Embeddable cover for a track without art of its own, or None. With wait, raises ArtPending
+    if the album's online lookup is still running after that many seconds.
+    """
+    if cover_cache is None or info is None or info.has_art:
+        return None
+    try:
+        with metrics.span('art'):
+            cover = find_album_art(filepath, info, art_resolver, wait)
+            return cover_cache.prepare(cover) if cover else None
+    except ArtPending:
+        raise
+    except Exception as e:
+        logger.warning("Could not prepare album art for %s: %s", os.path.basename(filepath), e)
+        return None
 
-def convert_and_move(filepath):
-    """Convert to ALAC if needed and move to destination"""
-    print(f"[INFO] Processing audio file: {os.path.basename(filepath)}")
+def add_cover_in_place(filepath, cover):
+    """Tag-only cover update for files that are already ALAC"""
     try:
-        if is_alac(filepath):
-            # Already ALAC, just move it to dest
-            shutil.move(filepath, DEST_FOLDER)
+        with metrics.span('art'):
+            embed_art_in_place(filepath, cover)
+        metrics.inc('slsync_art_embedded_total', method='tag')
+    except Exception as e:
+        logger.warning("Could not embed album art in %s: %s", os.path.basename(filepath), e)
+
+class IngestJob:
+    """One audio file on its way through the ingest stages"""
+    __slots__ = ('path', 'info', 'route', 'cover', 'late_cover', 'converted', 'slot', 'digests', 'digester')
+
+    def __init__(self, path):
+        self.path = path
+        self.info = None
+        self.route = None
+        self.cover = None
+        self.late_cover = False  # the cover lookup was still running at conversion time
+        self.converted = None
+        self.slot = None  # staging folder holding the converted file
+        self.digests = None  # audio hash of the download, if the duplicate check computed it
+        self.digester = None  # audio hash of the converted file, computed by ffmpeg otherwise
+
+    def audio_digests(self):
+        """Audio hash of the file being imported (the same for the download and its ALAC copy), or None"""
+        if self.digests is not None:
+            return self.digests
+        return self.digester.result() if self.digester is not None else None
+
+    def __repr__(self):
+        return os.path.basename(self.path)
+
+class AlbumJob:
+    """
+    The tracks of one folder (or one folder inside a zip) travelling through the ingest
+    stages together: probed in one batch, checked against the library with one index
+    lookup per album, given one cover, and published to DEST_FOLDER in one burst.
+    """
+    __slots__ = ('source', 'tracks', 'imported', 'duplicates', 'failed', 'started')
+
+    def __init__(self, source, tracks):
+        self.source = source
+        self.tracks = tracks
+        self.imported = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    @property
+    def name(self):
+        return os.path.basename(self.source).rstrip('!')
+
+    def __repr__(self):
+        return f"{self.name} ({len(self.tracks)} track(s))"
+
+def album_group(info):
+    """Tracks with the same album artist and album share one cover"""
+    return normalize_tag(info.tag('albumartist') or info.tag('artist')), normalize_tag(info.tag('album'))
+
+def move_to_library(filepath, info=None, cover=None, converted=None, digests=None):
+    """
+    Move a converted file (or a file that was already ALAC, adding the cover to its tags first)
+    to DEST_FOLDER. The file only ever appears there by an atomic rename, and the download
+    is only deleted once its converted copy is in place. Returns its path in DEST_FOLDER.
+    """
+    with metrics.span('move'):
+        if converted:
+            final_path = move_to_dest(converted, DEST_FOLDER, staging_dir)
+            remove_source(filepath)
         else:
-            # Convert to ALAC
-            alac_filepath = convert_to_alac(filepath)
-            if alac_filepath:
-                shutil.move(alac_filepath, DEST_FOLDER)
-        print(f"[SUCCESS] Moved ALAC file to your library: {os.path.basename(filepath)}")
+            prepare = (lambda path: add_cover_in_place(path, cover)) if cover else None
+            final_path = move_to_dest(filepath, DEST_FOLDER, staging_dir, prepare)
+    logger.info("Moved ALAC file to your library: %s", os.path.basename(filepath))
+    if digests is not None and probe_cache is not None:
+        # Music moves the file on into the library; the index claims the hash when it shows up there
+        try:
+            st = os.stat(final_path)
+            probe_cache.stash((st.st_size, st.st_mtime_ns), PCM_DIGESTS_KIND, digests)
+        except OSError:
+            pass  # already moved on: it will be hashed when first compared
+    return final_path
+
+def route_file(filepath, info=None):
+    """Pick the move/remux/transcode route for a file and count it"""
+    route = conversion_route(filepath, info)
+    metrics.inc('slsync_routes_total', route=route)
+    logger.debug("Route for %s: %s", os.path.basename(filepath), route)
+    return route
+
+def conversion_done(filepath, ok, error=None, state=None):
+    """Per-job completion hook: journals the outcome and lets a zip archive go once all its tracks are handled"""
+    state = state or ('done' if ok else 'failed')
+    metrics.inc('slsync_files_total', outcome=state)
+    if ingest_journal is not None:
+        ingest_journal.finish(filepath, state)
+    zip_member = split_zip_member_path(filepath)
+    if zip_member:
+        zip_tracker.done(zip_member[0], ok)
+
+def track_done(album, job, ok, state=None):
+    """conversion_done for one track of an album job, counted towards the album's report"""
+    conversion_done(job.path, ok, state=state)
+    if state == 'duplicate':
+        album.duplicates += 1
+    elif ok:
+        album.imported += 1
+    else:
+        album.failed += 1
+
+def album_done(album):
+    """Album-level completion report, once every track has been imported, skipped or has failed"""
+    if album.failed:
+        outcome = 'partial' if album.imported else 'failed'
+    else:
+        outcome = 'done' if album.imported else 'duplicate'
+    metrics.inc('slsync_albums_total', outcome=outcome)
+    metrics.observe('slsync_album_seconds', time.monotonic() - album.started)
+    logger.info("Finished album %s: %s imported, %s duplicate(s), %s failed",
+                album.name, album.imported, album.duplicates, album.failed)
+
+def download_digests(audio_file):
+    """Audio hash of a download (through the probe cache for plain files), or None if it can't be decoded"""
+    try:
+        if probe_cache is None or split_zip_member_path(audio_file):
+            return hash_audio_stream(audio_file)
+        return probe_cache.get_or_compute(audio_file, PCM_DIGESTS_KIND, hash_audio_stream)
     except Exception as e:
-        print(f"[ERROR] Failed to process {os.path.basename(filepath)}: {e}")
+        logger.warning("Could not hash %s: %s", os.path.basename(audio_file), e)
+        return None
 
-def process_path(path):
-        """Common processing logic for both created and moved events"""
-        # Ignore browsers download process
-        if '.download' in path:
-            return 
+def hash_matches(digests):
+    """Library files with exactly the same audio as a download, found by hash whatever their tags say"""
+    if digests is None or library_index is None or not library_index.has_hashes():
+        return []
+    return library_index.find_by_hash(digests[0])
+
+def duplicate_candidates(audio_file, info, album_entries=None):
+    """Library files that may hold the same track as audio_file (matched in album_entries, if given)"""
+    if library_index is not None:
+        if album_entries is not None:
+            candidates = match_album(album_entries, info)
+        else:
+            candidates = library_index.find_candidates(audio_file, info)
+        if fingerprint_index is not None:
+            # Acoustic matches catch copies whose tags differ
+            try:
+                matches = fingerprint_index.query(cached_fingerprint(audio_file, probe_cache))
+            except Exception as e:
+                logger.warning("Could not fingerprint %s: %s", os.path.basename(audio_file), e)
+                matches = []
+            candidates += [p for p in matches if p not in candidates]
+        return candidates
+    # No index: fall back to guessing the Apple Music path
+    dest_path = construct_audio_dest(LIBRARY_FOLDER, audio_file, '.m4a', info)
+    return [dest_path] if os.path.exists(dest_path) else []
+
+def find_duplicate(audio_file, info, album_entries=None, digests=None):
+    """Return the library file audio_file duplicates, or None. digests is its audio hash, if already computed."""
+    matches = hash_matches(digests)
+    if matches:
+        # Same hash as an indexed track: a duplicate even if it was re-tagged
+        return matches[0]
+    for candidate in duplicate_candidates(audio_file, info, album_entries):
+        duplicate = is_duplicate(audio_file, candidate, dup_criteria, probe_cache, info, digests)
+        if USE_AUDIO_HASH and library_index is not None and probe_cache is not None:
+            # The comparison hashed the library track; index it so later lookups find it by hash
+            found, candidate_digests = probe_cache.peek(candidate, PCM_DIGESTS_KIND)
+            if found:
+                library_index.set_hash(candidate, candidate_digests[0])
+        if duplicate:
+            return candidate
+    return None
+
+def prefetch_album_art(album):
+    """Start the cover art lookups for an album job in the background so they are ready before the tracks need them"""
+    if art_resolver is None:
+        return
+    # All tracks of the job share a folder, and so its cover.jpg
+    if find_local_art(art_directory(album.tracks[0].path)):
+        return
+    started = set()
+    for job in album.tracks:
+        if job.info is None or job.info.has_art:
+            continue
+        artist = job.info.tag('albumartist') or job.info.tag('artist')
+        album_name = job.info.tag('album')
+        if artist and album_name and album_group(job.info) not in started:
+            started.add(album_group(job.info))
+            art_resolver.prefetch(artist, album_name)
+
+def discover_tracks(path):
+    """Yield a job for every audio file under path that hasn't been ingested yet"""
+    # Ignore browsers download process
+    if '.download' in path:
+        return
+    owned_zips = {}
+    try:
+        for audio_file in metrics.timed_iter(find_audio_files(path, SUPPORTED_EXTENSIONS), 'discover'):
+            zip_member = split_zip_member_path(audio_file)
+            if zip_member:
+                # Another batch is already working through this archive. The one that claims it
+                # seals it below, so an archive whose members were all ingested before still goes.
+                if zip_member[0] not in owned_zips:
+                    owned_zips[zip_member[0]] = zip_tracker.claim(zip_member[0])
+                if not owned_zips[zip_member[0]]:
+                    continue
+            try:
+                stamp = path_stamp(audio_file)
+            except (OSError, KeyError):
+                if zip_member:
+                    zip_tracker.keep(zip_member[0])
+                continue
+            if ingest_journal is not None and ingest_journal.is_settled(audio_file, stamp):
+                continue
+            if zip_member:
+                zip_tracker.add(zip_member[0])
+            if ingest_journal is not None:
+                ingest_journal.mark(audio_file, stamp, 'queued')
+            yield IngestJob(audio_file)
+    except Exception as e:
+        logger.error("Error processing %s: %s", os.path.basename(path), e)
+        # Members after the error were never looked at
+        for zip_path, owned in owned_zips.items():
+            if owned:
+                zip_tracker.keep(zip_path)
+    finally:
+        for zip_path, owned in owned_zips.items():
+            if owned:
+                zip_tracker.seal(zip_path)
+
+def discover_stage(path):
+    """Yield an album job for every folder (or folder inside a zip) under path with tracks to ingest"""
+    tracks = discover_tracks(path)
+    try:
+        for source, jobs in group_consecutive(tracks, lambda job: os.path.dirname(job.path), ALBUM_MAX_TRACKS):
+            yield AlbumJob(source, jobs)
+    finally:
+        tracks.close()
+
+def probe_stage(album):
+    """Probe an album's tracks in one batch: one ffmpeg launch covers everything mutagen can't measure"""
+    with metrics.span('probe'):
+        infos = probe_many([job.path for job in album.tracks])
+    for job in album.tracks:
+        job.info = infos.get(job.path)
+        if job.info is None:
+            # Let the conversion have a go at files nothing could read
+            logger.warning("Could not probe %s", os.path.basename(job.path))
+    return album
+
+def dedup_stage(album):
+    """Drop duplicates of library tracks, with one index lookup per album; start the album art lookups for the rest"""
+    if should_skip_duplicates:
+        snapshots = {}
+        kept = []
+        for job in album.tracks:
+            try:
+                duplicate = None
+                if job.info is not None:
+                    with metrics.span('dedup'):
+                        album_entries = None
+                        if library_index is not None:
+                            key = (normalize_tag(job.info.tag('artist')), normalize_tag(job.info.tag('album')))
+                            if key not in snapshots:
+                                snapshots[key] = library_index.find_album(*key)
+                            album_entries = snapshots[key]
+                        if USE_AUDIO_HASH:
+                            # Decoded once here: compared with every candidate, then stashed for the library copy
+                            job.digests = download_digests(job.path)
+                        duplicate = find_duplicate(job.path, job.info, album_entries, job.digests)
+            except Exception as e:
+                logger.error("Duplicate check failed for %s: %s", os.path.basename(job.path), e)
+                track_done(album, job, False)
+                continue
+            if duplicate:
+                logger.info("Skipping duplicate: %s", job.path)
+                track_done(album, job, True, state='duplicate')
+            else:
+                kept.append(job)
+        album.tracks = kept
+    if not album.tracks:
+        album_done(album)
+        return None
+    prefetch_album_art(album)
+    return album
+
+def route_stage(album):
+    """Decide from the probe whether each track can be moved as-is, only remuxed, or must be transcoded"""
+    for job in album.tracks:
+        job.route = route_file(job.path, job.info)
+    return album
+
+def assign_covers(album):
+    """
+    Resolve one cover per album in the job and hand it to every track without art of its own.
+    Conversion doesn't wait on the network: a cover whose online lookup isn't done within
+    ALBUM_ART_CONVERT_WAIT is left to embed_late_covers() in the move stage.
+    """
+    covers = {}
+    pending = set()
+    for job in album.tracks:
+        if job.info is None or job.info.has_art:
+            continue
+        group = album_group(job.info)
+        if group not in covers:
+            try:
+                covers[group] = album_cover(job.path, job.info, ALBUM_ART_CONVERT_WAIT)
+            except ArtPending:
+                covers[group] = None
+                pending.add(group)
+        job.cover = covers[group]
+        job.late_cover = group in pending
+    return album
+
+def embed_late_covers(album):
+    """Tag the covers conversion didn't wait for onto the staged files, before they are published"""
+    covers = {}
+    for job in album.tracks:
+        if not job.late_cover:
+            continue
+        group = album_group(job.info)
+        if group not in covers:
+            try:
+                covers[group] = album_cover(job.path, job.info, ALBUM_ART_TIMEOUT)
+            except ArtPending:
+                logger.info("Album art for %s is still being looked up; importing without it", album.name)
+                covers[group] = None
+        cover = covers[group]
+        if cover is None:
+            continue
+        if job.converted:
+            add_cover_in_place(job.converted, cover)
+        else:
+            job.cover = cover  # tagged on its way to DEST_FOLDER
+
+async def convert_track(job):
+    """Remux or convert one track into the staging folder; returns True if it is ready to move"""
+    global conversion_slots
+    if job.route == ROUTE_MOVE:
+        return True
+    if conversion_slots is None:
+        # Bounds ffmpeg processes across all albums being converted at once
+        conversion_slots = asyncio.Semaphore(CONVERSION_WORKERS or os.cpu_count() or 1)
+    loop = asyncio.get_running_loop()
+    async with conversion_slots:
+        if staging_dir:
+            job.slot = await loop.run_in_executor(None, new_staging_slot, staging_dir)
+        if USE_AUDIO_HASH and job.digests is None:
+            # Hash the audio in the same ffmpeg run, so the library copy never needs decoding for it
+            job.digester = PcmDigester()
+        with metrics.span(job.route):
+            job.converted = await convert_to_alac_async(
+                job.path, job.cover, job.slot, job.route == ROUTE_REMUX, job.digester)
+    if not job.converted:
+        release_staging_slot(job.slot)
+        return False
+    await loop.run_in_executor(None, mark_slot_done, job.slot, job.path)
+    if job.cover:
+        metrics.inc('slsync_art_embedded_total', method='ffmpeg')
+    return True
+
+async def convert_stage(album):
+    """Find the album's cover, then remux or convert its tracks concurrently with asyncio ffmpeg subprocesses"""
+    loop = asyncio.get_running_loop()
+    logger.info("Processing album: %s", album)
+    await loop.run_in_executor(None, assign_covers, album)
+    results = await asyncio.gather(*(convert_track(job) for job in album.tracks), return_exceptions=True)
+    kept = []
+    for job, result in zip(album.tracks, results):
+        if result is True:
+            kept.append(job)
+            continue
+        if isinstance(result, Exception):
+            logger.error("Failed to convert %s: %s", os.path.basename(job.path), result)
+        track_done(album, job, False)
+    album.tracks = kept
+    if not kept:
+        album_done(album)
+        return None
+    return album
+
+def move_stage(album):
+    """Publish an album's tracks to DEST_FOLDER back to back, so Music imports the album in one go"""
+    embed_late_covers(album)
+    for job in album.tracks:
         try:
-            audio_files = find_audio_files(path, SUPPORTED_EXTENSIONS)
-            for audio_file in audio_files:
-                dest_path = construct_audio_dest(LIBRARY_FOLDER, audio_file, '.m4a')
-                if should_skip_duplicates and os.path.exists(dest_path):
-                    if is_duplicate(audio_file, dest_path, dup_criteria):
-                        print(f"[DUPLICATE] Skipping duplicate: {audio_file}")
-                        continue
-                convert_and_move(audio_file)
+            move_to_library(job.path, job.info, job.cover, job.converted, job.audio_digests())
         except Exception as e:
-            print(f"[ERROR] Error processing {os.path.basename(path)}: {e}")
-    
+            # The finished conversion stays in its slot; the next start publishes it
+            logger.error("Failed to move %s: %s", os.path.basename(job.path), e)
+            track_done(album, job, False)
+        else:
+            release_staging_slot(job.slot)
+            track_done(album, job, True)
+    album_done(album)
+
+def stage_failed(stage, album, error):
+    """Pipeline error hook: the remaining tracks of an album job that blows up in any stage are journaled as failed"""
+    if isinstance(album, AlbumJob):
+        for job in album.tracks:
+            release_staging_slot(job.slot)
+            track_done(album, job, False)
+        album_done(album)
+
+class IngestContext:
+    """The caches, journal and indexes the ingest stages share, as set up by build_context()"""
+
+    def __init__(self, staging_dir, probe_cache, ingest_journal, library_index, fingerprint_index, art_resolver):
+        self.staging_dir = staging_dir
+        self.probe_cache = probe_cache
+        self.ingest_journal = ingest_journal
+        self.library_index = library_index
+        self.fingerprint_index = fingerprint_index
+        self.art_resolver = art_resolver
+
+    def close(self):
+        if self.art_resolver is not None:
+            self.art_resolver.close()
+        self.probe_cache.trim()
+        self.probe_cache.close()
+        self.ingest_journal.close()
+        if self.fingerprint_index is not None:
+            self.fingerprint_index.close()
+        if self.library_index is not None:
+            self.library_index.close()
+
+def build_context(dest_folder=None, cache_path=None):
+    """
+    Open everything the ingest stages share, publishing to dest_folder and keeping state in
+    cache_path (DEST_FOLDER and CACHE_PATH by default), and make it what the stages use:
+    finishes conversions an interrupted run left staged and indexes the library.
+    """
+    global DEST_FOLDER, staging_dir, probe_cache, ingest_journal, library_index, fingerprint_index
+    global zip_tracker, conversion_slots, cover_cache, art_resolver
+    DEST_FOLDER = dest_folder or DEST_FOLDER
+    cache_path = cache_path or CACHE_PATH
+    staging_dir = staging_dir_for(DEST_FOLDER, STAGING_FOLDER)
+    if staging_dir:
+        logger.info("Staging conversions in %s", staging_dir)
+
+    probe_cache = ProbeCache(cache_path, CACHE_MAX_ENTRIES)
+    ingest_journal = IngestJournal(cache_path)
+    if staging_dir:
+        # Conversions an interrupted run finished but never published
+        for path in recover_staging_slots(staging_dir, DEST_FOLDER):
+            ingest_journal.finish(path, 'done')
+    pruned = ingest_journal.prune(lambda p: os.path.exists(source_path(p)))
+    if pruned:
+        logger.info("Dropped %s finished entries from the ingest journal", pruned)
+
+    library_index = fingerprint_index = None
+    if should_skip_duplicates and LIBRARY_INDEX_ENABLED and LIBRARY_FOLDER and os.path.isdir(LIBRARY_FOLDER):
+        logger.info("Indexing library: %s", LIBRARY_FOLDER)
+        library_index = LibraryIndex(LIBRARY_FOLDER, cache_path, SUPPORTED_EXTENSIONS, probe_cache)
+        library_index.build()
+        if USE_FINGERPRINT:
+            # Fingerprinting the library takes a while; it fills in the background
+            fingerprint_index = FingerprintIndex(probe_cache, FINGERPRINT_THRESHOLD)
+            fingerprint_index.sync_in_background(library_index.stamps)
+
+    cover_cache = art_resolver = None
+    if ALBUM_ART_ENABLED:
+        cover_cache = CoverCache(os.path.join(ALBUM_ART_CACHE_DIR, 'resized'), ALBUM_ART_MAX_SIZE)
+        if ALBUM_ART_ONLINE_LOOKUP:
+            art_resolver = ArtResolver(
+                cache_path, ALBUM_ART_CACHE_DIR, ALBUM_ART_MUSICBRAINZ_URL, ALBUM_ART_COVERART_URL,
+                ALBUM_ART_RATE, ALBUM_ART_WORKERS, ALBUM_ART_TIMEOUT, ALBUM_ART_MISS_TTL
+            )
+
+    zip_tracker = ZipTracker()
+    conversion_slots = None  # created on the event loop of the pipeline that first converts
+    return IngestContext(staging_dir, probe_cache, ingest_journal, library_index, fingerprint_index, art_resolver)
+
+def build_pipeline():
+    """The album-job ingest pipeline: discover, probe, dedup, route, convert, move"""
+    return IngestPipeline([
+        Stage('discover', discover_stage, DISCOVER_WORKERS, fan_out=True),
+        Stage('probe', probe_stage, PROBE_WORKERS),
+        Stage('dedup', dedup_stage, DEDUP_WORKERS),
+        Stage('route', route_stage, ROUTE_WORKERS),
+        Stage('convert', convert_stage, CONVERSION_WORKERS or os.cpu_count() or 1, blocking=False),
+        Stage('move', move_stage, MOVE_WORKERS),
+    ], CONVERSION_QUEUE_SIZE, stage_failed)
+
+def process_path(path):
+    """Queue a path (file or folder) for the ingest pipeline"""
+    pipeline.submit(path)
+
+def refresh_library(paths):
+    """Apply a batch of library folder changes to the library index and the fingerprint index"""
+    library_index.refresh(paths)
+    if fingerprint_index is not None:
+        fingerprint_index.sync_in_background(library_index.stamps)
+
+def process_batch(paths):
+    """Process one coalesced batch of event paths"""
+    for path in paths:
+        process_path(path)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='slsync', description='Import downloads into the Apple Music library.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('watch', help='monitor the download folders (the default)')
+    dedupe = commands.add_parser('dedupe', help='report duplicate tracks in LIBRARY_FOLDER')
+    dedupe.add_argument('--report', default=os.path.join(script_dir, 'slsync_dedupe.json'),
+                        help='where to write the report (default: %(default)s)')
+    dedupe.add_argument('--format', choices=['json', 'csv'], help='report format (default: from the extension)')
+    dedupe.add_argument('--mode', choices=[MODE_HASH, MODE_FINGERPRINT], default=MODE_HASH,
+                        help='compare decoded audio exactly, or by acoustic fingerprint (default: %(default)s)')
+    dedupe.add_argument('--workers', type=int, default=0, help='scan processes (default: one per CPU)')
+    dedupe.add_argument('--library', default=LIBRARY_FOLDER, help='folder to scan (default: LIBRARY_FOLDER)')
+    dedupe.add_argument('--restart', action='store_true', help='discard progress saved by earlier scans')
+    return parser.parse_args(argv)
+
+def run_dedupe(args):
+    """Scan the library for duplicate tracks and write a report. Returns the exit status."""
+    if not args.library or not os.path.isdir(args.library):
+        logger.error("Library folder not found: %s", args.library)
+        return 1
+    if args.mode == MODE_FINGERPRINT and not fingerprint_available():
+        logger.error("--mode fingerprint needs numpy (pip install numpy)")
+        return 1
+    scan = DedupeScan(args.library, CACHE_PATH, SUPPORTED_EXTENSIONS, args.workers, args.mode, FINGERPRINT_THRESHOLD)
+    try:
+        if args.restart:
+            scan.reset()
+        logger.info("Scanning %s for duplicates (%s)...", args.library, args.mode)
+        scan.run()
+        groups, redundant, reclaimable = write_report(scan.groups(), args.report, args.format)
+    except KeyboardInterrupt:
+        logger.info("Scan interrupted; run it again to continue where it stopped")
+        return 130
+    finally:
+        scan.close()
+    logger.info("Found %s duplicate group(s), %s redundant file(s) taking %.1f MB; report written to %s",
+                groups, redundant, reclaimable / 1e6, args.report)
+    return 0
+
 
 class DownloadHandler(FileSystemEventHandler):
     
-    def __init__(self):
-        self.processed= set()
+    def __init__(self, coalescer, tracker=None, recorder=None):
+        self.coalescer = coalescer
+        # New files may still be being written: the tracker holds them until they settle
+        self.tracker = tracker
+        self.recorder = recorder
+
+    def on_any_event(self, event):
+        if self.recorder is not None:
+            self.recorder.record(event)
 
     def on_created(self, event):
-        process_path(event.src_path)
+        if '.download' in event.src_path:
+            return
+        (self.tracker or self.coalescer).add(event.src_path)
+
+    def on_modified(self, event):
+        if self.tracker is not None and not event.is_directory:
+            self.tracker.touch(event.src_path)
     
     def on_moved(self, event):
         # Only handle browsers download completion: .download -> final file
         if '.download' in event.src_path and '.download' not in event.dest_path:
-            print(f"[INFO] Browser completed download: {os.path.basename(event.dest_path)}")
-            process_path(event.dest_path)
+            logger.info("Browser completed download: %s", os.path.basename(event.dest_path))
+            self.coalescer.add(event.dest_path)
 
 if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'dedupe':
+        sys.exit(run_dedupe(args))
+
+    context = build_context()
+
+    library_observer = None
+    if library_index is not None and LIBRARY_INDEX_WATCH:
+        library_coalescer = EventCoalescer(refresh_library, EVENT_SETTLE_SECONDS, EVENT_MAX_WAIT_SECONDS)
+        library_observer = Observer()
+        library_observer.schedule(LibraryIndexHandler(library_coalescer), LIBRARY_FOLDER, recursive=True)
+        library_observer.start()
+
+    # Start the ingest pipeline before any events can arrive
+    pipeline = build_pipeline()
+    coalescer = EventCoalescer(process_batch, EVENT_SETTLE_SECONDS, EVENT_MAX_WAIT_SECONDS)
+    stability_tracker = None
+    if STABILITY_QUIET_SECONDS > 0:
+        stability_tracker = StabilityTracker(
+            coalescer.add, STABILITY_QUIET_SECONDS, STABILITY_CHECK_INTERVAL,
+            STABILITY_MAX_WAIT_SECONDS, STABILITY_OPEN_FILE_CHECK
+        )
+
+    # Expose queue depths and cache effectiveness
+    def pipeline_gauge(field):
+        return lambda: {(('stage', name),): stats[field] for name, stats in pipeline.stats().items()}
+    metrics.gauge('slsync_pipeline_queue_depth', pipeline_gauge('queued'), 'Items waiting for each pipeline stage')
+    metrics.gauge('slsync_pipeline_active', pipeline_gauge('active'), 'Items each pipeline stage is working on')
+    metrics.gauge('slsync_event_pending', lambda: coalescer.stats()['pending'], 'Event paths waiting to settle')
+    metrics.gauge('slsync_events_raw', lambda: coalescer.stats()['raw_events'], 'Filesystem events received')
+    metrics.gauge('slsync_events_jobs', lambda: coalescer.stats()['jobs'], 'Paths processed after coalescing')
+    if stability_tracker is not None:
+        metrics.gauge('slsync_downloads_settling', lambda: stability_tracker.stats()['pending'],
+                      'New downloads waiting to stop changing')
+    metrics.gauge('slsync_probe_cache_hits', lambda: probe_cache.stats()['hits'], 'Probe cache hits')
+    metrics.gauge('slsync_probe_cache_misses', lambda: probe_cache.stats()['misses'], 'Probe cache misses')
+    metrics.gauge('slsync_probe_cache_hit_rate', lambda: probe_cache.stats()['hit_rate'], 'Probe cache hit rate')
+    if art_resolver is not None:
+        metrics.gauge('slsync_art_cache_hits', lambda: art_resolver.stats()['hits'], 'Albums whose cover came from the art cache')
+        metrics.gauge('slsync_art_inflight', lambda: art_resolver.stats()['inflight'], 'Album art lookups in progress')
+    if library_index is not None:
+        metrics.gauge('slsync_library_index_tracks', lambda: len(library_index), 'Tracks in the library index')
+    if fingerprint_index is not None:
+        metrics.gauge('slsync_fingerprint_index_tracks', lambda: len(fingerprint_index), 'Library tracks with an acoustic fingerprint')
+    metrics_server = start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+    stats_writer = StatsFileWriter(os.path.join(script_dir, METRICS_STATS_FILE), METRICS_INTERVAL) if METRICS_STATS_FILE else None
+
     # Start monitoring
+    recorder = TraceRecorder(os.path.join(script_dir, TRACE_FILE), DOWNLOAD_FOLDERS) if TRACE_FILE else None
     observers = []
     for folder in DOWNLOAD_FOLDERS:
         if os.path.exists(folder):
-            event_handler = DownloadHandler()
+            event_handler = DownloadHandler(coalescer, stability_tracker, recorder)
             observer = Observer()
             observer.schedule(event_handler, folder, recursive=True)
             observer.start()
             observers.append(observer)
-            print(f"[INFO] Monitoring: {folder}")
+            logger.info("Monitoring: %s", folder)
         else:
-            print(f"[WARNING] Skipping non-existent folder: {folder}")
+            logger.warning("Skipping non-existent folder: %s", folder)
 
-    # Now perform the initial scan
-    print("[INFO] Performing initial scan of download folders...")
+    # Resume jobs a previous run queued but never finished
+    unfinished = list(dict.fromkeys(source_path(p) for p in ingest_journal.in_flight()))
+    if unfinished:
+        logger.info("Resuming %s unfinished job(s) from the last run...", len(unfinished))
+        for path in unfinished:
+            process_path(path)
+
+    # Now perform the initial scan (already ingested files are skipped via the journal)
+    logger.info("Performing initial scan of download folders...")
     for folder in DOWNLOAD_FOLDERS:
         if os.path.exists(folder) and os.path.isdir(folder):
-            print(f"[INFO] Looking for audio files in folder: {folder}")
+            logger.info("Looking for audio files in folder: %s", folder)
             process_path(folder)
         else:
-            print(f"[WARNING] Download folder does not exist: {folder}")
+            logger.warning("Download folder does not exist: %s", folder)
 
-    print('[INFO] Press Ctrl+C to stop monitoring')
+    logger.info('Press Ctrl+C to stop monitoring')
 
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
-        print("\n[INFO] Stopping monitors...")
+        logger.info("Stopping monitors...")
         for observer in observers:
             observer.stop()
+        if library_observer is not None:
+            library_observer.stop()
 
     for observer in observers:
         observer.join()
+    if recorder is not None:
+        recorder.close()
+    if library_observer is not None:
+        library_observer.join()
+        library_coalescer.stop()
+    if stability_tracker is not None:
+        stability_tracker.stop()
+        logger.info("Download stability summary: %s", stability_tracker.stats())
+    coalescer.stop()
+    logger.info("Event summary: %s", coalescer.stats())
+
+    logger.info("Waiting for queued conversions to finish...")
+    pipeline.shutdown(wait=True)
+    logger.info("Pipeline summary: %s", pipeline.stats())
+    logger.info("Probe cache summary: %s", probe_cache.stats())
+    context.close()
+    if art_resolver is not None:
+        logger.info("Album art summary: %s", art_resolver.stats())
+    if stats_writer is not None:
+        stats_writer.stop()
+    if metrics_server is not None:
+        metrics_server.shutdown()
 
-    print("[INFO] Monitoring stopped")
\ No newline at end of file
+    logger.info("Monitoring stopped")
\ No newline at end of file
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = '[%(levelname)s] %(message)s'
+
+
+def setup_logging(level='INFO'):
+    """Configure leveled logging for slsync. Disabled levels cost nothing: messages use lazy %-formatting."""
+    logging.basicConfig(level=getattr(logging, str(level).upper(), logging.INFO), format=LOG_FORMAT)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in key) + '}'
+
+
+class Metrics:
+    """
+    Process-wide counters, timing summaries and gauges.
+    Gauges are callbacks sampled at export time, so queue depths and cache hit
+    rates are read from their owners rather than pushed on every change.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}   # name -> {label key: value}
+        self.summaries = {}  # name -> {label key: [count, sum, max]}
+        self.gauges = {}     # name -> callback returning a number or {label key: number}
+        self.help = {}
+
+    def inc(self, name, value=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            series = self.summaries.setdefault(name, {})
+            entry = series.get(key)
+            if entry is None:
+                series[key] = [1, value, value]
+            else:
+                entry[0] += 1
+                entry[1] += value
+                entry[2] = max(entry[2], value)
+
+    def gauge(self, name, callback, help_text=None):
+        """Register a gauge; callback returns a number, or a dict of {labels dict as tuple: number}"""
+        with self.lock:
+            self.gauges[name] = callback
+            if help_text:
+                self.help[name] = help_text
+
+    @contextmanager
+    def span(self, stage):
+        """Time a block of work as one observation of slsync_stage_seconds{stage=...}"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('slsync_stage_seconds', time.perf_counter() - start, stage=stage)
+
+    def timed_iter(self, iterable, stage):
+        """Yield from an iterable, charging the time spent producing each item to `stage`"""
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.observe('slsync_stage_seconds', time.perf_counter() - start, stage=stage)
+                return
+            self.observe('slsync_stage_seconds', time.perf_counter() - start, stage=stage)
+            yield item
+
+    def _sample_gauges(self):
+        with self.lock:
+            gauges = list(self.gauges.items())
+        samples = {}
+        for name, callback in gauges:
+            try:
+                value = callback()
+            except Exception as e:
+                logger.debug("Gauge %s failed: %s", name, e)
+                continue
+            samples[name] = value if isinstance(value, dict) else {(): value}
+        return samples
+
+    def snapshot(self):
+        """All metrics as plain JSON-friendly data"""
+        gauges = self._sample_gauges()
+        with self.lock:
+            def series(table, fn):
+                return {name: [dict(labels=dict(k), **fn(v)) for k, v in values.items()]
+                        for name, values in table.items()}
+            return {
+                'timestamp': time.time(),
+                'counters': series(self.counters, lambda v: {'value': v}),
+                'summaries': series(self.summaries, lambda v: {'count': v[0], 'sum': v[1], 'max': v[2]}),
+                'gauges': series(gauges, lambda v: {'value': v}),
+            }
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        gauges = self._sample_gauges()
+        lines = []
+        with self.lock:
+            for name, values in sorted(self.counters.items()):
+                lines.append(f'# TYPE {name} counter')
+                for key, value in values.items():
+                    lines.append(f'{name}{_format_labels(key)} {value}')
+            for name, values in sorted(self.summaries.items()):
+                lines.append(f'# TYPE {name} summary')
+                for key, (count, total, _) in values.items():
+                    labels = _format_labels(key)
+                    lines.append(f'{name}_count{labels} {count}')
+                    lines.append(f'{name}_sum{labels} {total}')
+                lines.append(f'# TYPE {name}_max gauge')
+                for key, (_, _, peak) in values.items():
+                    lines.append(f'{name}_max{_format_labels(key)} {peak}')
+            for name, values in sorted(gauges.items()):
+                if name in self.help:
+                    lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} gauge')
+                for key, value in values.items():
+                    lines.append(f'{name}{_format_labels(key)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# Shared registry used by all modules
+metrics = Metrics()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body, content_type = metrics.render_prometheus().encode(), 'text/plain; version=0.0.4'
+        elif self.path.split('?')[0] == '/stats.json':
+            body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics server: " + format, *args)
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """Serve /metrics (Prometheus) and /stats.json on localhost from a daemon thread"""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    logger.info("Metrics available at http://%s:%s/metrics", host, server.server_address[1])
+    return server
+
+
+class StatsFileWriter:
+    """Periodically rewrite a JSON snapshot of the metrics (atomically, via a temp file)"""
+
+    def __init__(self, path, interval=10.0):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='stats-writer', daemon=True)
+        self.thread.start()
+
+    def write(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(metrics.snapshot(), f, indent=2)
+        os.replace(tmp, self.path)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                logger.warning("Could not write stats file %s: %s", self.path, e)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.write()
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+_EXHAUSTED = object()
+
+
+def group_consecutive(items, key, max_size=None):
+    """
+    Yield (key, list) for each run of consecutive items with the same key, splitting
+    runs longer than max_size. Works on generators, holding one run at a time.
+    """
+    group = []
+    current = None
+    for item in items:
+        item_key = key(item)
+        if group and (item_key != current or (max_size and len(group) >= max_size)):
+            yield current, group
+            group = []
+        current = item_key
+        group.append(item)
+    if group:
+        yield current, group
+
+
+class Stage:
+    """
+    One step of an IngestPipeline.
+    `fn` takes an item and returns the item to hand to the next stage, or None to
+    drop it. Blocking functions run on the stage's own thread pool; coroutine
+    functions (blocking=False) run on the event loop. A fan_out stage returns an
+    iterable and every item it yields goes downstream, so one folder can become
+    many files without the whole listing being held in memory.
+    """
+
+    def __init__(self, name, fn, workers=1, blocking=True, fan_out=False):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.blocking = blocking
+        self.fan_out = fan_out
+        self.executor = None
+        self.queue = None
+        self.active = 0
+        self.processed = 0
+        self.failed = 0
+
+
+class IngestPipeline:
+    """
+    Run items through a chain of stages on an asyncio loop in a background thread.
+    Stages are connected by bounded queues and each has its own worker limit, so
+    I/O-bound and CPU-bound steps overlap while a full queue makes the stage in
+    front of it wait. submit() blocks the calling thread the same way, which turns
+    a flood of downloads into backpressure instead of a pile of threads.
+    """
+
+    def __init__(self, stages, queue_size=64, on_error=None):
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.on_error = on_error
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.tasks = []
+        self.thread = threading.Thread(target=self._run, name='ingest-pipeline', daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        logger.info("Ingest pipeline started: %s", ', '.join(f'{s.name} x{s.workers}' for s in stages))
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(maxsize=self.queue_size)
+            if stage.blocking:
+                stage.executor = ThreadPoolExecutor(max_workers=stage.workers, thread_name_prefix=stage.name)
+        for i, stage in enumerate(self.stages):
+            downstream = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            for _ in range(stage.workers):
+                self.tasks.append(self.loop.create_task(self._worker(stage, downstream)))
+        self.loop.call_soon(self.ready.set)
+        self.loop.run_forever()
+
+    async def _call(self, stage, fn, *args):
+        if stage.blocking:
+            return await self.loop.run_in_executor(stage.executor, fn, *args)
+        return await fn(*args)
+
+    async def _worker(self, stage, downstream):
+        while True:
+            item = await stage.queue.get()
+            if item is _STOP:
+                stage.queue.task_done()
+                return
+            stage.active += 1
+            try:
+                result = await self._call(stage, stage.fn, item)
+                if stage.fan_out:
+                    results = iter(result or ())
+                    try:
+                        while True:
+                            out = await self.loop.run_in_executor(stage.executor, next, results, _EXHAUSTED)
+                            if out is _EXHAUSTED:
+                                break
+                            if downstream is not None:
+                                await downstream.queue.put(out)
+                    finally:
+                        close = getattr(results, 'close', None)
+                        if close is not None:
+                            await self.loop.run_in_executor(stage.executor, close)
+                elif result is not None and downstream is not None:
+                    await downstream.queue.put(result)
+                stage.processed += 1
+            except Exception as e:
+                stage.failed += 1
+                logger.error("%s stage failed for %s: %s", stage.name, item, e)
+                if self.on_error is not None:
+                    try:
+                        self.on_error(stage.name, item, e)
+                    except Exception as hook_error:
+                        logger.error("Pipeline error hook failed: %s", hook_error)
+            finally:
+                stage.active -= 1
+                stage.queue.task_done()
+
+    def submit(self, item):
+        """Queue an item for the first stage, waiting while that stage's queue is full"""
+        asyncio.run_coroutine_threadsafe(self.stages[0].queue.put(item), self.loop).result()
+
+    async def _drain(self):
+        # Upstream stages only feed downstream ones, so joining in order leaves nothing behind
+        for stage in self.stages:
+            await stage.queue.join()
+
+    def join(self):
+        """Wait until every submitted item has been through all stages"""
+        asyncio.run_coroutine_threadsafe(self._drain(), self.loop).result()
+
+    def stats(self):
+        return {
+            stage.name: {
+                'workers': stage.workers,
+                'queued': stage.queue.qsize(),
+                'active': stage.active,
+                'processed': stage.processed,
+                'failed': stage.failed,
+            }
+            for stage in self.stages
+        }
+
+    def shutdown(self, wait=True):
+        """Stop the workers, after finishing all queued items if wait is set"""
+        async def stop():
+            if wait:
+                await self._drain()
+                for stage in self.stages:
+                    for _ in range(stage.workers):
+                        await stage.queue.put(_STOP)
+            else:
+                for task in self.tasks:
+                    task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        asyncio.run_coroutine_threadsafe(stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        for stage in self.stages:
+            if stage.executor is not None:
+                stage.executor.shutdown(wait=True)
+        self.loop.close()
@@ -0,0 +1,347 @@
+import os
+import re
+import json
+import subprocess
+
+from mutagen import File as MutagenFile
+
+from zip_helpers import split_zip_member_path, zip_member_stat, open_zip_member
+
+# Raw tag keys -> easy-style field names, per tag format
+ID3_FIELDS = {
+    'TPE1': 'artist', 'TPE2': 'albumartist', 'TALB': 'album', 'TIT2': 'title',
+    'TRCK': 'tracknumber', 'TPOS': 'discnumber', 'TDRC': 'date', 'TCON': 'genre',
+}
+MP4_FIELDS = {
+    '\xa9ART': 'artist', 'aART': 'albumartist', '\xa9alb': 'album', '\xa9nam': 'title',
+    'trkn': 'tracknumber', 'disk': 'discnumber', '\xa9day': 'date', '\xa9gen': 'genre',
+}
+# Field aliases accepted by MediaProbe.tag()
+TAG_ALIASES = {'year': 'date', 'track': 'tracknumber', 'disc': 'discnumber', 'discc': 'discnumber'}
+# mutagen module of the stream info -> codec name, for formats whose info has no codec attribute
+INFO_CODECS = {
+    'mutagen.flac': 'flac', 'mutagen.mp3': 'mp3', 'mutagen.wave': 'pcm', 'mutagen.aiff': 'pcm',
+    'mutagen.oggvorbis': 'vorbis', 'mutagen.oggopus': 'opus', 'mutagen.oggflac': 'flac', 'mutagen.aac': 'aac',
+}
+# ffmpeg's names for the tags it prints -> easy-style field names
+FFMPEG_FIELDS = {'album_artist': 'albumartist', 'track': 'tracknumber', 'disc': 'discnumber'}
+FFMPEG_CHANNELS = {'mono': 1, 'stereo': 2}
+# Inputs per ffmpeg launch in probe_many (keeps the command line short)
+FFMPEG_BATCH_SIZE = 32
+
+_INPUT_RE = re.compile(r'^Input #(\d+), ')
+_DURATION_RE = re.compile(r'^  Duration: (?:(\d+):(\d+):([\d.]+)|N/A).*?(?:bitrate: (\d+) kb/s)?$')
+_STREAM_RE = re.compile(r'^  Stream #\d+:\d+\S*: (Audio|Video): (\w+)(.*)$')
+_STREAM_KBPS_RE = re.compile(r'^(\d+) kb/s')
+_TAG_RE = re.compile(r'^    (\w+)\s*: (.*)$')
+
+
+class MediaProbe:
+    """Everything the pipeline needs to know about one version of one audio file"""
+
+    __slots__ = ('path', 'size', 'mtime_ns', 'tags', 'codec', 'duration', 'bitrate',
+                 'sample_rate', 'channels', 'has_art')
+
+    def __init__(self, path, size, mtime_ns, tags, codec, duration, bitrate, sample_rate, channels, has_art):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.tags = tags
+        self.codec = codec
+        self.duration = duration
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.has_art = has_art
+
+    def tag(self, field):
+        field = field.lower()
+        return self.tags.get(TAG_ALIASES.get(field, field))
+
+    def audio_property(self, field):
+        key = field.upper()
+        if key == 'DURATION':
+            return self.duration
+        if key == 'BITRATE':
+            return self.bitrate
+        if key == 'SAMPLE_RATE':
+            return self.sample_rate
+        if key == 'CHANNELS':
+            return self.channels
+        if key == 'CODEC':
+            return self.codec
+        return None
+
+    def is_current(self):
+        """True if the file on disk is still the version that was probed"""
+        try:
+            if split_zip_member_path(self.path):
+                return zip_member_stat(self.path) == (self.size, self.mtime_ns)
+            st = os.stat(self.path)
+        except (OSError, KeyError, ValueError):
+            return False
+        return st.st_size == self.size and st.st_mtime_ns == self.mtime_ns
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def __repr__(self):
+        return f"MediaProbe({os.path.basename(self.path)!r}, codec={self.codec!r}, duration={self.duration!r})"
+
+
+def _first(value):
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return value
+
+
+def _read_tags(audio):
+    """Flatten a mutagen tag container into easy-style {field: str}"""
+    tags = {}
+    raw = getattr(audio, 'tags', None)
+    if raw is None:
+        return tags
+    type_name = type(raw).__name__
+    if type_name == 'ID3':
+        for frame_id, field in ID3_FIELDS.items():
+            frame = raw.get(frame_id)
+            if frame is not None and frame.text:
+                tags[field] = str(frame.text[0])
+    elif type_name == 'MP4Tags':
+        for key, field in MP4_FIELDS.items():
+            value = _first(raw.get(key))
+            if value is None:
+                continue
+            if isinstance(value, tuple):
+                number, total = value
+                value = f"{number}/{total}" if total else str(number)
+            tags[field] = str(value)
+    else:
+        # Vorbis comments (FLAC, Ogg) and other dict-like containers already use plain field names
+        try:
+            for key, value in raw.items():
+                value = _first(value)
+                if value is not None and str(key).lower() not in tags:
+                    tags[str(key).lower()] = str(value)
+        except (AttributeError, TypeError, ValueError):
+            pass
+    return tags
+
+
+def _has_art(audio):
+    raw = getattr(audio, 'tags', None)
+    if getattr(audio, 'pictures', None):
+        return True
+    if raw is None:
+        return False
+    try:
+        keys = list(raw.keys())
+    except (AttributeError, TypeError):
+        return False
+    return any(k.startswith('APIC') or k == 'covr' or k.lower() == 'metadata_block_picture' for k in keys)
+
+
+def ffprobe_bitrate(filepath):
+    """Ask ffprobe for the bitrate of the first audio stream (for formats mutagen can't measure)"""
+    try:
+        cmd = [
+            'ffprobe',
+            '-v', 'error',
+            '-select_streams', 'a:0',
+            '-show_entries', 'stream=bit_rate:format=bit_rate',
+            '-of', 'json',
+            filepath
+        ]
+        data = json.loads(subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode('utf-8'))
+        streams = data.get('streams', [])
+        value = (streams[0].get('bit_rate') if streams else None) or data.get('format', {}).get('bit_rate')
+        return int(value) if value else None
+    except Exception:
+        return None
+
+
+def ffprobe_codec(filepath):
+    """Ask ffprobe for the codec of the first audio stream (for containers mutagen can't read, e.g. CAF)"""
+    try:
+        cmd = [
+            'ffprobe',
+            '-v', 'error',
+            '-select_streams', 'a:0',
+            '-show_entries', 'stream=codec_name',
+            '-of', 'json',
+            filepath
+        ]
+        data = json.loads(subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode('utf-8'))
+        streams = data.get('streams', [])
+        return streams[0].get('codec_name') if streams else None
+    except Exception:
+        return None
+
+
+def _parse_ffmpeg_inputs(stderr):
+    """
+    {input index: facts} from the input listing ffmpeg prints before it complains about the missing output.
+    The bitrate is the audio stream's, like ffprobe_bitrate(); the container's (which counts embedded
+    art and container overhead) is only used when the stream line has none, e.g. FLAC.
+    """
+    inputs = {}
+    container_bitrates = {}
+    current = None
+    for line in stderr.splitlines():
+        match = _INPUT_RE.match(line)
+        if match:
+            index = int(match.group(1))
+            current = inputs[index] = {
+                'tags': {}, 'codec': None, 'duration': None, 'bitrate': None,
+                'sample_rate': None, 'channels': None, 'has_art': False,
+            }
+            continue
+        if current is None:
+            continue
+        match = _TAG_RE.match(line)
+        if match:
+            field = match.group(1).lower()
+            current['tags'].setdefault(FFMPEG_FIELDS.get(field, field), match.group(2).strip())
+            continue
+        match = _DURATION_RE.match(line)
+        if match:
+            hours, minutes, seconds, kbps = match.groups()
+            if seconds is not None:
+                current['duration'] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+            if kbps:
+                container_bitrates[index] = int(kbps) * 1000
+            continue
+        match = _STREAM_RE.match(line)
+        if match:
+            kind, codec, rest = match.groups()
+            if kind == 'Video':
+                current['has_art'] = current['has_art'] or '(attached pic)' in rest
+            elif current['codec'] is None:
+                current['codec'] = codec
+                details = [part.strip() for part in rest.split(',')]
+                for part in details:
+                    if part.endswith(' Hz') and part[:-3].isdigit():
+                        current['sample_rate'] = int(part[:-3])
+                    elif part in FFMPEG_CHANNELS:
+                        current['channels'] = FFMPEG_CHANNELS[part]
+                    elif _STREAM_KBPS_RE.match(part):
+                        current['bitrate'] = int(_STREAM_KBPS_RE.match(part).group(1)) * 1000
+    for index, facts in inputs.items():
+        if facts['bitrate'] is None:
+            facts['bitrate'] = container_bitrates.get(index)
+    return inputs
+
+
+def ffmpeg_input_info(filepaths):
+    """
+    Stream facts for many files from one ffmpeg launch: `ffmpeg -i a -i b ...` without an
+    output lists every input's codec, duration, bitrate and tags, then exits.
+    Returns {path: facts}; files ffmpeg can't open are left out.
+    """
+    results = {}
+    pending = list(filepaths)
+    while pending:
+        batch, pending = pending[:FFMPEG_BATCH_SIZE], pending[FFMPEG_BATCH_SIZE:]
+        cmd = ['ffmpeg', '-hide_banner', '-nostdin']
+        for path in batch:
+            cmd += ['-i', path]
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60)
+        except (OSError, subprocess.SubprocessError):
+            return results
+        parsed = _parse_ffmpeg_inputs(proc.stderr.decode(errors='replace'))
+        for i, path in enumerate(batch):
+            if i not in parsed:
+                # ffmpeg gives up at the first input it can't open: skip it and carry on with the rest
+                pending = batch[i + 1:] + pending
+                break
+            results[path] = parsed[i]
+    return results
+
+
+def probe(filepath, cache=None):
+    """
+    Open a file once and collect its tags, stream info, codec, bitrate and embedded
+    art presence. With a ProbeCache the result is reused until the file changes.
+    """
+    if cache is not None:
+        return MediaProbe.from_dict(cache.get_or_compute(filepath, 'probe', lambda p: _probe(p).to_dict()))
+    return _probe(filepath)
+
+
+def probe_many(filepaths, cache=None):
+    """
+    probe() for a batch of files, e.g. one album. Tags and stream info still come from
+    mutagen, but bitrates it can't measure, and files it can't read at all (e.g. CAF),
+    are filled in from a single ffmpeg launch for the batch instead of an ffprobe each.
+    Returns {path: MediaProbe}; files nothing could read are left out.
+    """
+    results = {}
+    unread = []
+    for path in filepaths:
+        if cache is not None:
+            found, value = cache.get(path, 'probe')
+            if found:
+                results[path] = MediaProbe.from_dict(value)
+                continue
+        try:
+            results[path] = _probe(path, measure_bitrate=False)
+        except Exception:
+            if not split_zip_member_path(path):
+                unread.append(path)
+    to_ask = unread + [p for p, info in results.items() if not info.bitrate and not split_zip_member_path(p)]
+    facts = ffmpeg_input_info(to_ask) if to_ask else {}
+    for path in to_ask:
+        found = facts.get(path)
+        if found is None:
+            continue
+        if path in results:
+            results[path].bitrate = found['bitrate']
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        results[path] = MediaProbe(
+            path=path, size=st.st_size, mtime_ns=st.st_mtime_ns, **found)
+    if cache is not None:
+        for info in results.values():
+            cache.put(info.path, 'probe', info.to_dict(), (info.size, info.mtime_ns))
+    return results
+
+
+def _probe(filepath, measure_bitrate=True):
+    if split_zip_member_path(filepath):
+        # Zip members are read in place from the archive
+        size, mtime_ns = zip_member_stat(filepath)
+        with open_zip_member(filepath) as member:
+            audio = MutagenFile(member)
+    else:
+        st = os.stat(filepath)
+        size, mtime_ns = st.st_size, st.st_mtime_ns
+        audio = MutagenFile(filepath)
+    if audio is None:
+        raise ValueError(f"Unsupported or unreadable file: {filepath}")
+    info = getattr(audio, 'info', None)
+    if info is None:
+        raise ValueError(f"No audio info found for file: {filepath}")
+    codec = getattr(info, 'codec', None) or INFO_CODECS.get(type(info).__module__, type(info).__name__)
+    bitrate = getattr(info, 'bitrate', None)
+    if not bitrate and measure_bitrate and not split_zip_member_path(filepath):
+        bitrate = ffprobe_bitrate(filepath)
+    return MediaProbe(
+        path=filepath,
+        size=size,
+        mtime_ns=mtime_ns,
+        tags=_read_tags(audio),
+        codec=codec,
+        duration=getattr(info, 'length', None),
+        bitrate=bitrate,
+        sample_rate=getattr(info, 'sample_rate', None),
+        channels=getattr(info, 'channels', None),
+        has_art=_has_art(audio),
+    )
@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+"""
+Replay a recorded download-folder trace against a fresh slsync and measure it.
+
+Record a trace by setting TRACE.FILE in config.yaml and using slsync as usual.
+The replayer re-enacts the recorded file operations (creates, growing writes,
+renames) in a temp directory at real or accelerated speed while slsync watches
+it, so event storms and debouncing behave as they did. Every audio file gets the
+content of a sample track, scaled to the size recorded at each event. With
+--stub-ffmpeg, conversions just sleep, so scheduling is measured without the
+encoder. Reports per-file event-to-import latency percentiles and the work slsync
+did: ffmpeg runs, CPU time and the events it saw.
+
+    python replay.py trace.jsonl --speed 4 --stub-ffmpeg 0.5 --output replay.json
+"""
+
+import os
+import io
+import re
+import sys
+import json
+import math
+import time
+import shutil
+import signal
+import zipfile
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+import yaml
+
+from trace_helpers import load_trace
+
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+DOWNLOAD_SUFFIX = '.download'
+_COPY_SUFFIX_RE = re.compile(r' \(\d+\)$')
+
+STUB_FFMPEG = '''#!{python}
+# Stand-in for ffmpeg written by replay.py: conversions to .m4a sleep and copy their
+# input; everything else (probes, PCM decoding) is handed to the real ffmpeg.
+import os, sys, time, shutil
+args = sys.argv[1:]
+outputs = [a for a in args if a.endswith('.m4a') and args[args.index(a) - 1] != '-i']
+if not outputs:
+    os.execv({real!r}, [{real!r}] + args)
+time.sleep({seconds!r})
+src = args[args.index('-i') + 1]
+with open(outputs[-1], 'wb') as out:
+    if src in ('pipe:0', '-'):
+        shutil.copyfileobj(sys.stdin.buffer, out)
+    else:
+        with open(src, 'rb') as f:
+            shutil.copyfileobj(f, out)
+'''
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    rank = max(1, math.ceil(pct / 100.0 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def final_name(path):
+    """Name a download will end up with once the browser drops its .download suffix"""
+    while path.endswith(DOWNLOAD_SUFFIX):
+        path = path[:-len(DOWNLOAD_SUFFIX)]
+    return path
+
+
+def write_stub_ffmpeg(bin_dir, seconds):
+    real = shutil.which('ffmpeg')
+    if real is None:
+        raise SystemExit("ffmpeg is needed even with --stub-ffmpeg (probes and hashing still use it)")
+    os.makedirs(bin_dir, exist_ok=True)
+    stub = os.path.join(bin_dir, 'ffmpeg')
+    with open(stub, 'w') as f:
+        f.write(STUB_FFMPEG.format(python=sys.executable, real=real, seconds=seconds))
+    os.chmod(stub, 0o755)
+
+
+def make_sample(root, seconds):
+    """A tagged FLAC test tone to stand in for every recorded audio file"""
+    from benchmark import ffmpeg_synth
+    path = os.path.join(root, 'sample.flac')
+    ffmpeg_synth(path, seconds, 440, 'flac', {'artist': 'Replay Artist', 'album': 'Replay Album', 'title': 'Replay'})
+    return path
+
+
+class Replay:
+    """Re-enacts the events of one trace under `root`, one download folder per recorded folder"""
+
+    def __init__(self, header, events, root, samples, supported_extensions, replay_deletes=False):
+        self.events = events
+        self.folders = [os.path.join(root, 'downloads', str(i)) for i in range(len(header['folders']))]
+        self.samples = {os.path.splitext(p)[1].lower(): p for p in samples}
+        self.default_sample = samples[0]
+        self.supported_extensions = supported_extensions
+        self.replay_deletes = replay_deletes
+        self.content = {}      # final name -> bytes
+        self.final_size = {}   # final name -> largest recorded size
+        self.last_write = {}   # final name -> index of the last event writing it
+        self.sources = {}      # final name of each audio file or zip -> time of its first event
+        for i, event in enumerate(events):
+            if event['dir'] or event['folder'] is None or event['type'] not in ('created', 'modified'):
+                continue
+            name = final_name(event['src'])
+            self.final_size[name] = max(self.final_size.get(name, 0), event['size'] or 0)
+            self.last_write[name] = i
+        for folder in self.folders:
+            os.makedirs(folder, exist_ok=True)
+
+    def _path(self, event, key='src'):
+        return os.path.join(self.folders[event['folder']], event[key])
+
+    def _is_source(self, name):
+        ext = os.path.splitext(name)[1].lower()
+        return ext == '.zip' or ext in self.supported_extensions
+
+    def _content(self, name):
+        if name not in self.content:
+            base, ext = os.path.splitext(os.path.basename(name))
+            ext = ext.lower()
+            if ext == '.zip':
+                buf = io.BytesIO()
+                with zipfile.ZipFile(buf, 'w') as zf:
+                    zf.write(self.default_sample, base + os.path.splitext(self.default_sample)[1])
+                self.content[name] = buf.getvalue()
+            elif ext in self.supported_extensions:
+                with open(self.samples.get(ext, self.default_sample), 'rb') as f:
+                    self.content[name] = f.read()
+            else:
+                self.content[name] = b'\0' * self.final_size.get(name, 0)
+        return self.content[name]
+
+    def _write(self, index, event):
+        path = self._path(event)
+        name = final_name(event['src'])
+        data = self._content(name)
+        if self.last_write.get(name) == index or not self.final_size.get(name):
+            length = len(data)
+        else:
+            length = len(data) * (event['size'] or 0) // self.final_size[name]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        current = os.path.getsize(path) if os.path.exists(path) else -1
+        if length > current:
+            with open(path, 'ab') as f:
+                f.write(data[max(current, 0):length])
+        elif length < current:
+            with open(path, 'wb') as f:
+                f.write(data[:length])
+
+    def _note_source(self, name, when):
+        if self._is_source(name) and name not in self.sources:
+            self.sources[name] = when
+
+    def apply(self, index, event, when):
+        if event['folder'] is None:
+            return
+        kind = event['type']
+        path = self._path(event)
+        if kind == 'created' and event['dir']:
+            os.makedirs(path, exist_ok=True)
+        elif kind in ('created', 'modified') and not event['dir']:
+            if kind == 'modified' and not os.path.exists(path):
+                return  # stale event for a file since renamed
+            self._write(index, event)
+            self._note_source(final_name(event['src']), when)
+        elif kind == 'moved':
+            dest = self._path(event, 'dest')
+            if os.path.exists(path):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.replace(path, dest)
+            if not event['dir']:
+                self._note_source(final_name(event['dest']), self.sources.pop(final_name(event['src']), when))
+                return
+            prefix = event['src'].rstrip(os.sep) + os.sep
+            for name in [n for n in self.sources if n.startswith(prefix)]:
+                self.sources[os.path.join(event['dest'], name[len(prefix):])] = self.sources.pop(name)
+        elif kind == 'deleted' and self.replay_deletes:
+            # Off by default: the trace also holds slsync removing sources it imported
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def run(self, speed=1.0, max_gap=None):
+        """Apply every event at its recorded time (divided by speed, idle gaps capped at max_gap)"""
+        start = time.monotonic()
+        offset = 0.0
+        previous = self.events[0]['t'] if self.events else 0.0
+        for i, event in enumerate(self.events):
+            gap = (event['t'] - previous) / speed
+            offset += min(gap, max_gap) if max_gap is not None else gap
+            previous = event['t']
+            delay = start + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.apply(i, event, time.monotonic())
+        return time.monotonic() - start
+
+
+class ImportWatcher:
+    """Polls the destination folder and notes when each new file shows up"""
+
+    def __init__(self, dest, interval=0.05):
+        self.dest = dest
+        self.interval = interval
+        self.seen = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='import-watcher', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            now = time.monotonic()
+            for entry in os.scandir(self.dest):
+                if not entry.name.startswith('.') and entry.name not in self.seen:
+                    self.seen[entry.name] = now
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def match_imports(sources, imported):
+    """Pair each source with the first unclaimed import of the same base name; returns latencies"""
+    waiting = {}
+    for name, started in sorted(sources.items(), key=lambda item: item[1]):
+        base = os.path.splitext(os.path.basename(name))[0]
+        waiting.setdefault(base, []).append(started)
+    latencies = []
+    for name, arrived in sorted(imported.items(), key=lambda item: item[1]):
+        base = _COPY_SUFFIX_RE.sub('', os.path.splitext(name)[0])
+        if waiting.get(base):
+            latencies.append(arrived - waiting[base].pop(0))
+    return sorted(latencies)
+
+
+def replay_config(args, root, folders):
+    """config.yaml with every path pointed into the replay directory"""
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    config.update({
+        'DOWNLOAD_FOLDERS': folders,
+        'DEST_FOLDER': os.path.join(root, 'dest'),
+        'LIBRARY_FOLDER': os.path.join(root, 'library'),
+        'STAGING_FOLDER': '',
+        'TRACE': {'FILE': ''},
+    })
+    config['SKIP_DUPLICATES'] = dict(config.get('SKIP_DUPLICATES') or {}, ENABLED=False)
+    config['CACHE'] = dict(config.get('CACHE') or {}, PATH=os.path.join(root, 'cache.db'))
+    config['METRICS'] = dict(config.get('METRICS') or {}, PORT=0, STATS_FILE=os.path.join(root, 'stats.json'))
+    config['ALBUM_ART'] = dict(config.get('ALBUM_ART') or {}, ONLINE_LOOKUP=False, CACHE_DIR=os.path.join(root, 'art'))
+    for folder in ('dest', 'library'):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+    path = os.path.join(root, 'config.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return path, config
+
+
+def start_slsync(config_path, root, bin_dir=None, timeout=60):
+    """Run main.py on the replay config and wait until it is watching"""
+    env = dict(os.environ, SLSYNC_CONFIG=config_path)
+    if bin_dir:
+        env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+    log_path = os.path.join(root, 'slsync.log')
+    log = open(log_path, 'w')
+    # SIGINT is how slsync is stopped cleanly, so make sure the child doesn't inherit it ignored
+    proc = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, 'main.py')], env=env,
+                            stdout=log, stderr=subprocess.STDOUT,
+                            preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_DFL))
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with open(log_path) as f:
+            if 'Press Ctrl+C' in f.read():
+                return proc, log
+        if proc.poll() is not None:
+            break
+        time.sleep(0.1)
+    proc.kill()
+    raise SystemExit(f"slsync did not start; see {log_path}")
+
+
+def stop_slsync(proc, log, timeout=120):
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    log.close()
+
+
+def work_summary(stats_path, cpu_seconds):
+    """Work slsync did, from its final stats file and the CPU time of it and its ffmpegs"""
+    work = {'cpu_seconds': round(cpu_seconds, 3)}
+    try:
+        with open(stats_path) as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        return work
+    for name, series in stats['summaries'].items():
+        if name.startswith('slsync_ffmpeg_'):
+            work[name[len('slsync_'):]] = round(sum(s['sum'] for s in series), 3)
+        if name == 'slsync_ffmpeg_wall_seconds':
+            work['ffmpeg_runs'] = sum(s['count'] for s in series)
+        if name == 'slsync_stage_seconds':
+            work['stage_seconds'] = {s['labels']['stage']: round(s['sum'], 3) for s in series}
+    for name, series in stats['counters'].items():
+        for s in series:
+            label = ','.join(f'{k}={v}' for k, v in sorted(s['labels'].items()))
+            work[f"{name[len('slsync_'):]}[{label}]" if label else name[len('slsync_'):]] = s['value']
+    for name in ('slsync_events_raw', 'slsync_events_jobs'):
+        if stats['gauges'].get(name):
+            work[name[len('slsync_'):]] = stats['gauges'][name][0]['value']
+    return work
+
+
+def replay(args):
+    header, events = load_trace(args.trace)
+    if not events:
+        raise SystemExit(f"{args.trace} has no events")
+    root = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='slsync-replay-')
+    os.makedirs(root, exist_ok=True)
+    try:
+        samples = args.sample or [make_sample(root, args.sample_seconds)]
+        folders = [os.path.join(root, 'downloads', str(i)) for i in range(len(header['folders']))]
+        config_path, config = replay_config(args, root, folders)
+        bin_dir = None
+        if args.stub_ffmpeg is not None:
+            bin_dir = os.path.join(root, 'bin')
+            write_stub_ffmpeg(bin_dir, args.stub_ffmpeg)
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        player = Replay(header, events, root, samples, set(config['SUPPORTED_EXTENSIONS']), args.replay_deletes)
+        proc, log = start_slsync(config_path, root, bin_dir)
+        watcher = ImportWatcher(config['DEST_FOLDER'], args.poll)
+        print(f"[REPLAY] {len(events)} event(s) from {args.trace} at {args.speed}x into {root}")
+        replay_seconds = player.run(args.speed, args.max_gap)
+        deadline = time.monotonic() + args.timeout
+        while len(watcher.seen) < len(player.sources) and time.monotonic() < deadline:
+            time.sleep(args.poll)
+        watcher.stop()
+        stop_slsync(proc, log)
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_seconds = usage.ru_utime + usage.ru_stime - before.ru_utime - before.ru_stime
+        latencies = match_imports(player.sources, watcher.seen)
+        return {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'trace': os.path.abspath(args.trace),
+            'events': len(events),
+            'speed': args.speed,
+            'stub_ffmpeg': args.stub_ffmpeg,
+            'replay_seconds': round(replay_seconds, 3),
+            'files': len(player.sources),
+            'imported': len(latencies),
+            'latency': {
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+            },
+            'work': work_summary(os.path.join(root, 'stats.json'), cpu_seconds),
+        }
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a recorded download trace against slsync and measure ingest latency.')
+    parser.add_argument('trace', help='trace file recorded via TRACE.FILE')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed-up factor (default: real time)')
+    parser.add_argument('--max-gap', type=float, help='cap idle gaps between events at this many seconds')
+    parser.add_argument('--stub-ffmpeg', type=float, metavar='SECONDS',
+                        help='replace conversions with a sleep of this many seconds')
+    parser.add_argument('--sample', action='append', help='audio file(s) to use as content (matched by extension)')
+    parser.add_argument('--sample-seconds', type=float, default=10, help='length of the generated sample track')
+    parser.add_argument('--replay-deletes', action='store_true',
+                        help='also replay deletions (the trace includes slsync removing imported sources)')
+    parser.add_argument('--config', default=os.path.join(SCRIPT_DIR, 'config.yaml'),
+                        help='settings to run slsync with; folders are replaced (default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for imports after the replay')
+    parser.add_argument('--poll', type=float, default=0.05, help='seconds between checks of the destination folder')
+    parser.add_argument('--workdir', help='replay here instead of a temp dir (kept afterwards)')
+    parser.add_argument('--keep', action='store_true', help='keep the temp dir after the run')
+    parser.add_argument('--output', help='also write the results as JSON here')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = replay(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    latency = results['latency']
+    print(f"[REPLAY] Imported {results['imported']} of {results['files']} file(s)")
+    if results['imported']:
+        print(f"[REPLAY] Event-to-import latency: p50 {latency['p50']:.2f}s  p90 {latency['p90']:.2f}s  "
+              f"p99 {latency['p99']:.2f}s  max {latency['max']:.2f}s")
+    for name, value in results['work'].items():
+        print(f"[REPLAY] {name:<36} {value}")
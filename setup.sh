@@ -25,7 +25,7 @@ pip install \
     'pyyaml>=6.0,<7.0' \
     'requests>=2.28,<3.0' \
     'tqdm>=4.64,<5.0' \
-    'pydub>=0.25,<1.0'
+    'numpy>=1.21'
 
 echo "Dependencies installed in $VENV_DIR."
 
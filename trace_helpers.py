@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+TRACE_VERSION = 1
+
+
+class TraceRecorder:
+    """
+    Append every watchdog event from the download folders to a JSON-lines trace, with
+    its time since recording started and the size of the file at that moment, so a
+    burst of downloads can be replayed later (see replay.py). The first line is a
+    header naming the watched folders; event paths are recorded relative to them.
+    """
+
+    def __init__(self, path, folders):
+        self.folders = [os.path.normpath(f) for f in folders]
+        self.lock = threading.Lock()
+        self.events = 0
+        self.start = time.monotonic()
+        self.file = open(path, 'a', buffering=1)
+        self._write({'version': TRACE_VERSION, 'folders': self.folders, 'started': time.time()})
+        logger.info("Recording download events to %s", path)
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+
+    def _relative(self, path):
+        """(folder index, path relative to that folder) for an event path"""
+        path = os.path.normpath(path)
+        for i, folder in enumerate(self.folders):
+            if path == folder or path.startswith(folder + os.sep):
+                return i, os.path.relpath(path, folder)
+        return None, path
+
+    def record(self, event):
+        now = time.monotonic() - self.start
+        target = getattr(event, 'dest_path', None) or event.src_path
+        size = None
+        if not event.is_directory:
+            try:
+                size = os.stat(target).st_size
+            except OSError:
+                pass
+        folder, src = self._relative(event.src_path)
+        record = {'t': round(now, 4), 'type': event.event_type, 'dir': event.is_directory,
+                  'folder': folder, 'src': src, 'size': size}
+        if getattr(event, 'dest_path', None):
+            record['dest'] = self._relative(event.dest_path)[1]
+        with self.lock:
+            if self.file.closed:
+                return
+            self._write(record)
+            self.events += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        logger.info("Recorded %s download event(s)", self.events)
+
+
+def load_trace(path):
+    """Read a trace file: returns (header, list of event records in time order)"""
+    header = None
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if 'version' in record:
+                # Appending to an existing trace starts a new session; keep the latest one
+                header = record
+                events = []
+            else:
+                events.append(record)
+    if header is None:
+        raise ValueError(f"{path} is not an slsync trace")
+    events.sort(key=lambda e: e['t'])
+    return header, events
@@ -0,0 +1,176 @@
+import os
+import logging
+import shutil
+import hashlib
+import zipfile
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Zip members are addressed as "<archive>.zip!/<member name>"
+ZIP_MEMBER_SEP = '!/'
+COVER_IMAGE_NAMES = {'cover.jpg', 'folder.jpg', 'artwork.jpg', 'front.jpg',
+                     'cover.png', 'folder.png', 'artwork.png', 'front.png'}
+# Containers ffmpeg can't demux from a pipe (index at the end of the file)
+UNPIPEABLE_EXTENSIONS = {'.m4a', '.mp4', '.alac', '.mov', '.caf'}
+
+
+def zip_member_path(zip_path, name):
+    return f"{zip_path}{ZIP_MEMBER_SEP}{name}"
+
+
+def split_zip_member_path(path):
+    """Return (zip_path, member_name) for a zip member path, or None for a regular path"""
+    idx = path.lower().find('.zip' + ZIP_MEMBER_SEP)
+    if idx < 0:
+        return None
+    split = idx + len('.zip')
+    return path[:split], path[split + len(ZIP_MEMBER_SEP):]
+
+
+def list_zip_members(zip_path, supported_extensions):
+    """
+    Read the central directory and return (audio member names, cover image member names).
+    Nothing is decompressed.
+    """
+    audio, covers = [], []
+    with zipfile.ZipFile(zip_path, 'r') as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            base = os.path.basename(info.filename)
+            if base.startswith('._') or '__MACOSX/' in info.filename:
+                continue
+            if os.path.splitext(base)[1].lower() in supported_extensions:
+                audio.append(info.filename)
+            elif base.lower() in COVER_IMAGE_NAMES:
+                covers.append(info.filename)
+    return audio, covers
+
+
+def open_zip_member(path):
+    """Open a zip member path for reading. The returned file object keeps its archive open."""
+    zip_path, name = split_zip_member_path(path)
+    zf = zipfile.ZipFile(zip_path, 'r')
+    try:
+        member = zf.open(name)
+    except Exception:
+        zf.close()
+        raise
+    # Close the archive together with the member
+    close = member.close
+    def close_both():
+        close()
+        zf.close()
+    member.close = close_both
+    return member
+
+
+def zip_member_stat(path):
+    """Return (size, mtime_ns) for a zip member, derived from the archive and member info"""
+    zip_path, name = split_zip_member_path(path)
+    with zipfile.ZipFile(zip_path, 'r') as zf:
+        info = zf.getinfo(name)
+    return info.file_size, os.stat(zip_path).st_mtime_ns
+
+
+def extract_zip_member(path, dest_path):
+    """Stream one member to dest_path without touching the rest of the archive"""
+    with open_zip_member(path) as src, open(dest_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    return dest_path
+
+
+def zip_covers_dir(zip_path):
+    """Temporary folder an archive's cover images are extracted to"""
+    key = hashlib.sha1(os.path.abspath(zip_path).encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), 'slsync-zip-covers', key)
+
+
+def extract_zip_covers(zip_path, covers):
+    """Write cover images to the archive's covers folder so the art lookup can find them"""
+    written = []
+    root = zip_covers_dir(zip_path)
+    for name in covers:
+        dest = os.path.normpath(os.path.join(root, name))
+        if not dest.startswith(root + os.sep):
+            logger.warning("Skipping cover outside the covers folder: %s", name)
+            continue
+        if os.path.exists(dest):
+            continue
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            written.append(extract_zip_member(zip_member_path(zip_path, name), dest))
+        except Exception as e:
+            logger.warning("Could not extract cover %s from %s: %s", name, os.path.basename(zip_path), e)
+    return written
+
+
+class ZipTracker:
+    """
+    Count outstanding member jobs per archive and delete the archive once every
+    member has been handled successfully. An archive is claimed by the discovery that
+    finds it first, which registers its members one at a time and then seals it; the
+    archive is only eligible for removal once sealed, even if no member needed a job.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = {}
+        self.sealed = set()
+        self.failed = set()
+
+    def claim(self, zip_path):
+        """Start tracking an archive; False if another discovery already is"""
+        with self.lock:
+            if zip_path in self.remaining:
+                return False
+            self.remaining[zip_path] = 0
+            return True
+
+    def keep(self, zip_path):
+        """Leave the archive in place: one of its members could not be queued"""
+        with self.lock:
+            if zip_path in self.remaining:
+                self.failed.add(zip_path)
+
+    def add(self, zip_path):
+        with self.lock:
+            self.remaining[zip_path] = self.remaining.get(zip_path, 0) + 1
+
+    def seal(self, zip_path):
+        """No more members of this archive will be registered"""
+        with self.lock:
+            if zip_path not in self.remaining:
+                return
+            self.sealed.add(zip_path)
+        self._maybe_remove(zip_path)
+
+    def done(self, zip_path, ok):
+        with self.lock:
+            if zip_path not in self.remaining:
+                return
+            self.remaining[zip_path] -= 1
+            if not ok:
+                self.failed.add(zip_path)
+        self._maybe_remove(zip_path)
+
+    def _maybe_remove(self, zip_path):
+        with self.lock:
+            if zip_path not in self.sealed or self.remaining.get(zip_path, 0) > 0:
+                return
+            del self.remaining[zip_path]
+            self.sealed.discard(zip_path)
+            failed = zip_path in self.failed
+            self.failed.discard(zip_path)
+        if failed:
+            logger.warning("Keeping %s: some tracks failed to import", os.path.basename(zip_path))
+            return
+        try:
+            os.remove(zip_path)
+            logger.info("Removed zip file: %s", os.path.basename(zip_path))
+        except Exception as e:
+            logger.warning("Could not remove zip file: %s", e)
+            return
+        shutil.rmtree(zip_covers_dir(zip_path), ignore_errors=True)